@@ -1,66 +1,61 @@
 import sys
 from scenarios import *
 from agent import Agent
-from utils import get_direction, is_facing_wampa
-
-def fit_grid(grid, item):
-    """Used for calculating breeze and stench locationsbased on pit and wampa
-    locations."""
-    grid_x, grid_y = grid
-    x, y = item
-    loc = []
-
-    if x < grid_x - 1:
-        loc += [[x+1, y]]
-    if x > 0:
-        loc += [[x-1, y]]
-    if y < grid_y - 1:
-        loc += [[x, y+1]]
-    if y > 0:
-        loc += [[x, y-1]]
-
-    return loc
+from utils import (ORIENTATION_DELTAS, PERCEPTS, STENCH, BREEZE, GASP, BUMP,
+                   SCREAM, GridIndex, get_orientation, is_facing_wampa,
+                   flags_to_percepts, pack_location)
+
+# indexes of the percept planes, in the order of the 5-element percept lists
+(STENCH_PLANE, BREEZE_PLANE, GASP_PLANE, BUMP_PLANE,
+ SCREAM_PLANE) = range(len(PERCEPTS))
+
 
 # ENVIRONMENT
 class WampaWorld:
     def __init__(self, worldInit):
         self.gridsize = worldInit['grid']
-        self.X = self.gridsize[0]
-        self.Y = self.gridsize[1]
+        self.X, self.Y = self.gridsize or (None, None)
         self.wampa = worldInit['wampa']
         self.pits = worldInit['pits']
         self.luke = worldInit['luke']
         self.wampaAlive = True
         self.is_playing = True
+        self.place_percepts()
+        self.agent = Agent(self)
 
-        # calculate breeze and stench locations
-        breeze = []
+    def place_percepts(self):
+        # prepopulate a bit plane per percept, one byte per room, indexed by
+        # the room's packed location
+        self.planes = [bytearray(self.X * self.Y) for _ in PERCEPTS]
+
+        # scatter breeze and stench around the pits and the Wampa
+        self.grid_index = GridIndex(tuple(self.gridsize))
         for pit in self.pits:
-            breeze += fit_grid(self.gridsize, pit)
-        stench = fit_grid(self.gridsize, self.wampa)
-
-        # prepopulate grid with percepts
-        self.grid = [
-            [
-                [
-                    "stench" if [x, y] in stench else None,
-                    "breeze" if [x, y] in breeze else None,
-                    None,  # "gasp" index
-                    None,  # "bump" index
-                    None   # "scream" index
-                ]
-                for y in range(self.Y)
-            ]
-            for x in range(self.X)
-        ]
+            for x, y in self.grid_index.adjacent_rooms(tuple(pit)):
+                self.planes[BREEZE_PLANE][pack_location(x, y, self.Y)] = 1
+        for x, y in self.grid_index.adjacent_rooms(tuple(self.wampa)):
+            self.planes[STENCH_PLANE][pack_location(x, y, self.Y)] = 1
 
         # set "gasp" percept at Luke's location
-        self.grid[self.luke[0]][self.luke[1]][2] = "gasp"
-        self.agent = Agent(self)
+        self.planes[GASP_PLANE][pack_location(*self.luke, self.Y)] = 1
+
+        # packed locations of the pits, the Wampa (while alive) and Luke
+        self.pit_locs = {pack_location(x, y, self.Y) for x, y in self.pits
+                         if 0 <= x < self.X and 0 <= y < self.Y}
+        self.wampa_loc = pack_location(*self.wampa, self.Y)
+        self.luke_loc = pack_location(*self.luke, self.Y)
 
     def get_percepts(self):
-        x, y = self.agent.loc
-        return self.grid[x][y]
+        loc = self.get_room_key()
+        return [percept if plane[loc] else None
+                for percept, plane in zip(PERCEPTS, self.planes)]
+
+    def get_percept_flags(self):
+        loc = self.get_room_key()
+        flags = 0
+        for i, plane in enumerate(self.planes):
+            flags |= plane[loc] << i
+        return flags
 
     def take_action(self, action):
         x, y = self.agent.loc
@@ -69,41 +64,32 @@ class WampaWorld:
         #R2 moves forward from whatever direction he's facing
         if action == "forward":
             moved = True
-            orientation = get_direction(self.agent.degrees)
-            movements = {
-                "up": (0, 1),
-                "down": (0, -1),
-                "left": (-1, 0),
-                "right": (1, 0)
-            }
-
-            dx, dy = movements.get(orientation, (0, 0))
+            dx, dy = ORIENTATION_DELTAS[get_orientation(self.agent.degrees)]
             new_x, new_y = x + dx, y + dy
 
-            if 0 <= new_x < len(self.grid) and 0 <= new_y < len(self.grid[0]):
+            if self.is_in_grid(new_x, new_y):
                 self.agent.loc = (new_x, new_y)
             else:
                 moved = False
 
-            if (self.get_location() == self.wampa and self.wampaAlive) or \
-                self.get_location() in self.pits:
+            loc = self.get_room_key()
+            if loc == self.wampa_loc or loc in self.pit_locs:
                 self.agent.score -= 1000
                 self.is_playing = False
             
-            percepts = self.get_percepts()
-            percepts[3] = "bump" if not moved else None  # reset bump = None if no bump
+            self.set_bump(loc, not moved)  # reset bump if no bump
 
         #R2 turns left
         elif action == "left":
             self.agent.turn_left()
-            percepts = self.get_percepts()
-            percepts[3] = None  # cannot experience a bump upon a turn
+            # cannot experience a bump upon a turn
+            self.set_bump(self.get_room_key(), False)
 
         #R2 turns right
         elif action == "right":
             self.agent.turn_right()
-            percepts = self.get_percepts()
-            percepts[3] = None  # cannot experience a bump upon a turn
+            # cannot experience a bump upon a turn
+            self.set_bump(self.get_room_key(), False)
 
         #R2 fires his blaster
         elif action == "shoot":
@@ -112,16 +98,16 @@ class WampaWorld:
                 if is_facing_wampa(self.agent):
                     self.wampaAlive = False
                     self.wampa = None
-                    for x in range(self.gridsize[0]):
-                        for y in range(self.gridsize[1]):
-                            self.grid[x][y][4] = "scream"  # scream everywhere
-                            self.grid[x][y][0] = None  # stench is gone
+                    self.wampa_loc = None
+                    self.spread_scream()
 
         #R2 grabs Luke
         elif action == "grab":
-            if self.get_location() == self.luke and not self.agent.has_luke:
+            if self.get_room_key() == self.luke_loc and \
+                    not self.agent.has_luke:
                 self.agent.has_luke = True
                 self.luke = None
+                self.luke_loc = None
 
         #R2 climbs out
         elif action == "climb":
@@ -132,15 +118,89 @@ class WampaWorld:
         else:
             raise ValueError("R2-D2 can only move Forward, turn Left, turn Right, Shoot, Grab, or Climb.")
     
-    def get_location(self):
+    def get_room_key(self):
+        """Return the key of R2-D2's room in pit_locs, wampa_loc, luke_loc
+        and the percept planes: its packed location."""
         x, y = self.agent.loc
-        return [x, y]
+        return pack_location(x, y, self.Y)
+
+    def is_in_grid(self, x, y):
+        return 0 <= x < self.X and 0 <= y < self.Y
+
+    def set_bump(self, loc, bumped):
+        self.planes[BUMP_PLANE][loc] = bumped
+
+    def spread_scream(self):
+        rooms = self.X * self.Y
+        # scream everywhere
+        self.planes[SCREAM_PLANE] = bytearray(b"\x01") * rooms
+        self.planes[STENCH_PLANE] = bytearray(rooms)  # stench is gone
+
+
+class SparseWampaWorld(WampaWorld):
+    """A WampaWorld that allocates nothing per room, for very large caves,
+    or unbounded ones if worldInit['grid'] is None. Pits are kept in a set
+    of rooms, and the percepts of a room are computed from its neighbours
+    the first time R2-D2 enters it. Rooms are keyed by (x, y) rather than
+    by packed ints (see get_room_key)."""
+
+    def place_percepts(self):
+        # rooms of the pits, the Wampa (while alive), Luke and the gasp
+        self.pit_locs = {(x, y) for x, y in self.pits
+                         if self.is_in_grid(x, y)}
+        self.wampa_loc = tuple(self.wampa)
+        self.luke_loc = self.gasp_loc = tuple(self.luke)
+        self.bump_locs = set()  # rooms where the last move bumped
+        self.room_flags = dict()  # {room: stench, breeze and gasp flags}
+
+    def get_percepts(self):
+        return flags_to_percepts(self.get_percept_flags())
+
+    def get_percept_flags(self):
+        loc = self.get_room_key()
+        flags = self.room_flags.get(loc)
+        if flags is None:
+            x, y = loc
+            flags = GASP if loc == self.gasp_loc else 0
+            for dx, dy in ORIENTATION_DELTAS:
+                adj_loc = (x + dx, y + dy)
+                if adj_loc in self.pit_locs:
+                    flags |= BREEZE
+                if adj_loc == self.wampa_loc:
+                    flags |= STENCH
+            self.room_flags[loc] = flags
+        if loc in self.bump_locs:
+            flags |= BUMP
+        if not self.wampaAlive:
+            flags |= SCREAM
+        return flags
+
+    def get_room_key(self):
+        """Return the key of R2-D2's room: the room (x, y) itself."""
+        return self.agent.loc
+
+    def is_in_grid(self, x, y):
+        return not self.gridsize or 0 <= x < self.X and 0 <= y < self.Y
+
+    def set_bump(self, loc, bumped):
+        if bumped:
+            self.bump_locs.add(loc)
+        else:
+            self.bump_locs.discard(loc)
+
+    def spread_scream(self):
+        self.room_flags.clear()  # stench is gone, scream is everywhere
 
 # RUN THE GAME
-def run_game(scenario):
-    w = WampaWorld(scenario)
+def run_game(scenario, sparse=False):
+    w = SparseWampaWorld(scenario) if sparse else WampaWorld(scenario)
+    # agents without the bit flag entry point get the percept list
+    record_percept_flags = getattr(w.agent, "record_percept_flags", None)
     while w.is_playing:
-        w.agent.record_percepts(w.get_percepts())
+        if record_percept_flags:
+            record_percept_flags(w.get_percept_flags())
+        else:
+            w.agent.record_percepts(w.get_percepts())
         w.agent.inference_algorithm()
         action = w.agent.choose_next_action()
         w.take_action(action)
@@ -5,19 +5,40 @@ def flatten(tup):
         return tup[0]
     return tup
 
+# Orientations as ints 0-3 (clockwise from "up"), with their (dx, dy)
+ORIENTATIONS = ("up", "right", "down", "left")
+ORIENTATION_DELTAS = ((0, 1), (1, 0), (0, -1), (-1, 0))
+
+# Percepts as bit flags, in the order of the 5-element percept lists
+PERCEPTS = ("stench", "breeze", "gasp", "bump", "scream")
+STENCH, BREEZE, GASP, BUMP, SCREAM = (1 << i for i in range(len(PERCEPTS)))
+
+def get_orientation(degrees):
+    """Return the orientation (0-3, an index of ORIENTATIONS) of degrees,
+    which is a multiple of 90."""
+    return degrees // 90 % 4
+
 def get_direction(degrees):
-    fraction = (degrees % 360) / 360
-    orientation = None
-    match fraction:
-        case 0:
-            orientation = "up"
-        case 0.25:
-            orientation = "right"
-        case 0.5:
-            orientation = "down"
-        case 0.75:
-            orientation = "left"
-    return orientation
+    if degrees % 90:
+        return None
+    return ORIENTATIONS[get_orientation(degrees)]
+
+def percepts_to_flags(percepts):
+    """Return the bit flags of a 5-element percept list."""
+    flags = 0
+    for i, percept in enumerate(percepts):
+        if percept:
+            flags |= 1 << i
+    return flags
+
+def flags_to_percepts(flags):
+    """Return the 5-element percept list of bit flags."""
+    return [percept if flags >> i & 1 else None
+            for i, percept in enumerate(PERCEPTS)]
+
+def pack_location(x, y, height):
+    """Return room (x, y) of a grid with height rows as a single int."""
+    return x * height + y
 
 def is_facing_wampa(agent):
     """You may wish to use this in all_safe_next_actions"""
@@ -25,8 +46,57 @@ def is_facing_wampa(agent):
         return False
     x, y = agent.loc
     wx, wy = agent.KB.wampa
-    direction = get_direction(agent.degrees)
-    return (direction == "up" and wx == x and wy > y) or \
-            (direction == "down" and wx == x and wy < y) or \
-            (direction == "left" and wx < x and wy == y) or \
-            (direction == "right" and wx > x and wy == y)
\ No newline at end of file
+    dx, dy = ORIENTATION_DELTAS[get_orientation(agent.degrees)]
+    if dx:
+        return wy == y and (wx - x) * dx > 0
+    return wx == x and (wy - y) * dy > 0
+
+class GridIndex:
+    """Gives each room (x, y) a dense integer index the first time it is
+    seen, and caches its neighbours: the adjacent rooms (within bounds, if
+    a (width, height) grid size is given) and the mask with the bit of each
+    adjacent room that has an index. Both grow lazily as rooms are found."""
+    deltas = ((0, 1), (0, -1), (1, 0), (-1, 0))
+
+    def __init__(self, bounds=None):
+        self.bounds = bounds
+        self.room_to_index = dict()  # {room: index}
+        self.index_to_room = []  # rooms in the order they were indexed
+        self.neighbours = []  # frozenset of the rooms adjacent to each room
+        self.adjacent_masks = []  # mask of indexed rooms adjacent to each room
+
+    def index(self, room):
+        """Return the index of room, assigning the next one to it (and
+        linking it to its indexed neighbours) the first time it is seen."""
+        index = self.room_to_index.get(room)
+        if index is None:
+            index = len(self.index_to_room)
+            self.room_to_index[room] = index
+            self.index_to_room.append(room)
+            x, y = room
+            neighbours = frozenset((x + dx, y + dy) for dx, dy in self.deltas)
+            if self.bounds:
+                width, height = self.bounds
+                neighbours = frozenset((x, y) for x, y in neighbours
+                                       if 0 <= x < width and 0 <= y < height)
+            self.neighbours.append(neighbours)
+            self.adjacent_masks.append(0)
+            for adj_room in neighbours:
+                adj_index = self.room_to_index.get(adj_room)
+                if adj_index is not None:
+                    self.adjacent_masks[adj_index] |= 1 << index
+                    self.adjacent_masks[index] |= 1 << adj_index
+        return index
+
+    def adjacent_rooms(self, room):
+        """Return the frozenset of rooms adjacent to room."""
+        return self.neighbours[self.index(room)]
+
+    def adjacent_mask(self, room):
+        """Return the mask with the bit of every room adjacent to room set,
+        indexing those rooms first if needed."""
+        index = self.index(room)
+        for adj_room in self.neighbours[index]:
+            if adj_room not in self.room_to_index:
+                self.index(adj_room)
+        return self.adjacent_masks[index]
\ No newline at end of file
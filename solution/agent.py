@@ -1,6 +1,17 @@
-from random import shuffle
+from time import perf_counter
+from random import Random, shuffle
+from collections import deque, OrderedDict
 from itertools import combinations as comb
-from utils import flatten, get_direction, is_facing_wampa
+from concurrent.futures import ProcessPoolExecutor, wait
+from utils import (
+    ORIENTATIONS, ORIENTATION_DELTAS, STENCH, BREEZE, GASP, BUMP, SCREAM,
+    GridIndex, get_direction, get_orientation, is_facing_wampa,
+    percepts_to_flags)
+
+try:
+    import numpy as np  # optional, only needed for the "numpy" backend
+except ImportError:
+    np = None
 
 
 # KNOWLEDGE BASE
@@ -15,11 +26,287 @@ class KB:
         self.gasp = False  # True if gasp has been perceived
         self.scream = False  # True if scream has been perceived
         self.walls = set()  # set of rooms (x, y) that are known to be walls
+        self.bounds = dict()  # {orientation: x or y of last rooms that way}
         self.pits = set()  # set of rooms (x, y) that are known to be pits
         self.wampa = None  # room (x, y) that is known to be the Wampa
         self.luke = None  # room (x, y) that is known to be Luke
 
 
+# SAT SOLVER
+class SATSolver:
+    """A small CDCL (DPLL with unit propagation and clause learning) solver.
+    Variables are the integers 1..num_vars, a literal is a variable or its
+    negation, and a clause is a list of literals. Clauses learned by a call
+    to solve are kept for the next ones."""
+    def __init__(self, num_vars, clauses):
+        self.num_vars = num_vars
+        self.clauses = []  # clauses with at least two literals
+        self.watches = {lit: [] for var in range(1, num_vars + 1)
+                        for lit in (var, -var)}  # {lit: watching clauses}
+        self.units = []  # literals of unit clauses
+        self.is_unsat = False  # True if the empty clause was added
+        self.activity = [0] * (num_vars + 1)  # conflicts each var was in
+        for clause in clauses:
+            self.add_clause(clause)
+
+    def add_clause(self, clause):
+        """Add clause, watching its first two literals."""
+        clause = list(dict.fromkeys(clause))
+        if any(-lit in clause for lit in clause):
+            return  # a tautology is always satisfied
+        if not clause:
+            self.is_unsat = True
+        elif len(clause) == 1:
+            self.units.append(clause[0])
+        else:
+            self.watches[clause[0]].append(len(self.clauses))
+            self.watches[clause[1]].append(len(self.clauses))
+            self.clauses.append(clause)
+
+    def lit_value(self, lit):
+        """Return 1 if lit is true, -1 if it is false and 0 if unassigned."""
+        value = self.value[abs(lit)]
+        return value if lit > 0 else -value
+
+    def assign(self, lit, reason):
+        """Make lit true at the current decision level, implied by the clause
+        with index reason (None for decisions and units)."""
+        var = abs(lit)
+        self.value[var] = 1 if lit > 0 else -1
+        self.level[var] = len(self.trail_lim)
+        self.reason[var] = reason
+        self.trail.append(lit)
+
+    def propagate(self):
+        """Assign every literal implied by unit propagation. Return the index
+        of a conflicting clause, or None if there is no conflict."""
+        while self.queue_head < len(self.trail):
+            false_lit = -self.trail[self.queue_head]
+            self.queue_head += 1
+            watching = self.watches[false_lit]
+            self.watches[false_lit] = []
+            for k, clause_index in enumerate(watching):
+                clause = self.clauses[clause_index]
+                if clause[0] == false_lit:
+                    clause[0], clause[1] = clause[1], clause[0]
+                if self.lit_value(clause[0]) == 1:
+                    self.watches[false_lit].append(clause_index)
+                    continue
+                # look for a new literal to watch instead of false_lit
+                for j in range(2, len(clause)):
+                    if self.lit_value(clause[j]) != -1:
+                        clause[1], clause[j] = clause[j], clause[1]
+                        self.watches[clause[1]].append(clause_index)
+                        break
+                else:
+                    self.watches[false_lit].append(clause_index)
+                    if self.lit_value(clause[0]) == -1:
+                        self.watches[false_lit].extend(watching[k + 1:])
+                        return clause_index
+                    self.assign(clause[0], clause_index)
+        return None
+
+    def analyze(self, conflict):
+        """Return (learned clause, backjump level) for the clause with index
+        conflict, using the first unique implication point. The asserting
+        literal of the learned clause comes first."""
+        current_level = len(self.trail_lim)
+        learned, seen = [], set()
+        clause, lit, num_open = self.clauses[conflict], None, 0
+        trail_index = len(self.trail) - 1
+        while True:
+            for q in clause:
+                var = abs(q)
+                if q == lit or var in seen or not self.level[var]:
+                    continue
+                seen.add(var)
+                self.activity[var] += 1
+                if self.level[var] == current_level:
+                    num_open += 1
+                else:
+                    learned.append(q)
+            while abs(self.trail[trail_index]) not in seen:
+                trail_index -= 1
+            lit = self.trail[trail_index]
+            trail_index -= 1
+            num_open -= 1
+            if not num_open:
+                break
+            clause = self.clauses[self.reason[abs(lit)]]
+        learned.sort(key=lambda q: -self.level[abs(q)])
+        backjump_level = self.level[abs(learned[0])] if learned else 0
+        return [-lit] + learned, backjump_level
+
+    def backjump(self, level):
+        """Undo every assignment made above decision level."""
+        if len(self.trail_lim) <= level:
+            return
+        for lit in self.trail[self.trail_lim[level]:]:
+            self.value[abs(lit)] = 0
+            self.reason[abs(lit)] = None
+        del self.trail[self.trail_lim[level]:]
+        del self.trail_lim[level:]
+        self.queue_head = len(self.trail)
+
+    def solve(self, assumptions=()):
+        """Return a satisfying assignment as a list of 1 (true) or -1 (false)
+        indexed by variable, in which every literal of assumptions is true,
+        or None if there is none."""
+        if self.is_unsat:
+            return None
+        self.value = [0] * (self.num_vars + 1)
+        self.level = [0] * (self.num_vars + 1)
+        self.reason = [None] * (self.num_vars + 1)
+        self.trail, self.trail_lim, self.queue_head = [], [], 0
+        for lit in self.units:
+            if self.lit_value(lit) == -1:
+                self.is_unsat = True
+                return None
+            if not self.lit_value(lit):
+                self.assign(lit, None)
+
+        while True:
+            conflict = self.propagate()
+            if conflict is not None:
+                if not self.trail_lim:
+                    self.is_unsat = True
+                    return None
+                learned, backjump_level = self.analyze(conflict)
+                self.backjump(backjump_level)
+                if len(learned) == 1:
+                    self.units.append(learned[0])
+                    self.assign(learned[0], None)
+                else:
+                    self.add_clause(learned)
+                    self.assign(learned[0], len(self.clauses) - 1)
+                continue
+
+            # decide the next assumption, or else the most active variable
+            level = len(self.trail_lim)
+            if level < len(assumptions):
+                lit = assumptions[level]
+                if self.lit_value(lit) == -1:
+                    return None
+                self.trail_lim.append(len(self.trail))
+                if not self.lit_value(lit):
+                    self.assign(lit, None)
+                continue
+            unassigned = [var for var in range(1, self.num_vars + 1)
+                          if not self.value[var]]
+            if not unassigned:
+                return list(self.value)
+            var = max(unassigned, key=lambda v: self.activity[v])
+            self.trail_lim.append(len(self.trail))
+            self.assign(-var, None)
+
+
+# PIT MODEL CHECKING
+def iter_gray_pit_masks(pit_indices, breeze_adjacent_masks, start, stop):
+    """Lazily yield the pit_mask of every subset of the rooms in pit_indices
+    with a pit in each room mask of breeze_adjacent_masks, for the steps
+    start to stop of the Gray code order over the subsets.
+
+    In Gray code order, each step only adds or removes a single pit. The
+    number of pits next to each breeze rule is updated with it, and a
+    subset is consistent when none of them is zero."""
+    can_be_pit = sum(1 << index for index in pit_indices)
+    if start >= stop or not all(adj_mask & can_be_pit
+                                for adj_mask in breeze_adjacent_masks):
+        return
+    rules_of_room = [[rule for rule, adj_mask in
+                      enumerate(breeze_adjacent_masks)
+                      if adj_mask >> index & 1]
+                     for index in pit_indices]
+
+    gray_code = start ^ start >> 1
+    pit_mask = sum(1 << index for bit, index in enumerate(pit_indices)
+                   if gray_code >> bit & 1)
+    num_adjacent_pits = [bin(adj_mask & pit_mask).count("1")
+                         for adj_mask in breeze_adjacent_masks]
+    num_unsatisfied = num_adjacent_pits.count(0)
+    if not num_unsatisfied:
+        yield pit_mask
+    for step in range(start + 1, stop):
+        flipped = (step & -step).bit_length() - 1
+        pit_mask ^= 1 << pit_indices[flipped]
+        if pit_mask >> pit_indices[flipped] & 1:
+            for rule in rules_of_room[flipped]:
+                num_adjacent_pits[rule] += 1
+                num_unsatisfied -= num_adjacent_pits[rule] == 1
+        else:
+            for rule in rules_of_room[flipped]:
+                num_adjacent_pits[rule] -= 1
+                num_unsatisfied += num_adjacent_pits[rule] == 0
+        if not num_unsatisfied:
+            yield pit_mask
+
+
+def summarize_pit_masks(pit_masks, wampa_indices):
+    """Return {wampa_index: (all_pits, any_pits, is_consistent)} over the
+    pit masks in pit_masks, for -1 and for each room in wampa_indices: the
+    pits in every and in some pit_mask without a pit in that room, and
+    whether there is any such pit_mask."""
+    summaries = dict.fromkeys([-1] + list(wampa_indices), (-1, 0, False))
+    for pit_mask in pit_masks:
+        for wampa_index, (every, some, _) in summaries.items():
+            if wampa_index < 0 or not pit_mask >> wampa_index & 1:
+                summaries[wampa_index] = (every & pit_mask,
+                                          some | pit_mask, True)
+    return summaries
+
+
+def summarize_pit_range(pit_indices, breeze_adjacent_masks, wampa_indices,
+                        start, stop):
+    """Return summarize_pit_masks over the steps start to stop of
+    iter_gray_pit_masks. Only plain ints and lists go in and out, so that
+    this can be run in a worker process."""
+    return summarize_pit_masks(
+        iter_gray_pit_masks(pit_indices, breeze_adjacent_masks, start, stop),
+        wampa_indices)
+
+
+# INFERENCE CACHE
+class InferenceCache:
+    """A bounded table of inference results keyed by KB fingerprint (see
+    Agent.KB_fingerprint), that drops the least recently used result once
+    it holds max_size of them. hits and misses count the lookups."""
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.results = OrderedDict()  # {fingerprint: inferences}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, fingerprint):
+        """Return the result kept for fingerprint, or None."""
+        if fingerprint not in self.results:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.results.move_to_end(fingerprint)
+        return self.results[fingerprint]
+
+    def put(self, fingerprint, result):
+        """Keep result for fingerprint, dropping the least recently used
+        result if the table is full."""
+        self.results[fingerprint] = result
+        self.results.move_to_end(fingerprint)
+        if len(self.results) > self.max_size:
+            self.results.popitem(last=False)
+
+    def clear(self):
+        """Drop every result and reset the statistics."""
+        self.results.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        """Return {"hits", "misses", "size"} of the table."""
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self.results)}
+
+
+inference_cache = InferenceCache()  # shared by every Agent in the process
+
+
 # AGENT
 class Agent:
     def __init__(self, world):
@@ -29,12 +316,39 @@ class Agent:
         self.degrees = 0
         self.blaster = True
         self.has_luke = False
-        self.orientation_to_delta = {
-            "up": (0, 1),  # (dx, dy)
-            "down": (0, -1),
-            "left": (-1, 0),
-            "right": (1, 0)
-        }
+        self.frontier_only = True  # only enumerate worlds over the frontier
+        self.backend = "python"  # inference backend, "python"/"numpy"/"sat"
+        self.numpy_max_rooms = 20  # most pit rooms in one numpy pit model
+        self.factorized = True  # solve the pit and wampa models separately
+        self.propagate = True  # try unit propagation before the backend
+        self.decompose = True  # split the pit model into components
+        self.incremental = True  # keep pit models between turns
+        self.processes = None  # worker processes for large pit models
+        self.parallel_threshold = 20  # pit rooms needed to use processes
+        self.kept_pool = None  # (processes, pool) kept by process_pool
+        self.deadline = None  # perf_counter() time to stop enumerating at
+        self.world_budget = None  # pit subsets that may be enumerated
+        self.worlds_checked = 0  # pit subsets enumerated by this inference
+        self.finished = True  # False if the last inference ran out of budget
+        self.plan_moves = False  # head for where to go next (see plan_action)
+        self.take_risks = False  # with plan_moves, risk a move if none is safe
+        self.max_risk = 0.5  # most risk of a pit or the wampa to be taken
+        self.max_exact_rooms = 12  # most pit rooms exact_risks enumerates
+        self.num_samples = 1000  # worlds drawn by sample_risks
+        self.sample_seed = None  # seed of sample_risks (None for a random one)
+        self.pit_prior = 0.2  # probability of a pit in a room a priori
+        self.kept_models = dict()  # pit models kept by pit_model
+        self.kept_summaries = dict()  # kept by factorized_model_summary
+        self.kept_wampa = (set(), set(), -1)  # state kept by wampa_mask
+        self.skip_unchanged = True  # skip inference if the KB is unchanged
+        self.inferred_state = None  # KB_state after the last inference
+        self.verdicts = dict()  # {room: queries entailed}, final ones only
+        self.use_cache = False  # share inferences through self.cache
+        self.cache = inference_cache  # InferenceCache shared by all agents
+        self.grid_index = GridIndex()  # room indexes and neighbour tables
+        self.room_to_index = self.grid_index.room_to_index
+        self.index_to_room = self.grid_index.index_to_room
+        self.adjacent_masks = self.grid_index.adjacent_masks
         self.KB = KB(self)
 
     def turn_left(self):
@@ -46,26 +360,28 @@ class Agent:
     def adjacent_locs(self, room):
         """Returns a set of tuples representing all possible adjacent
         locations to 'room'. Use this function to update KB.all_locs."""
-        x, y = room
-        deltas = [(0, 1), (0, -1), (1, 0), (-1, 0)]
-        return {(x+dx, y+dy) for dx, dy in deltas if (x+dx, y+dy)}
+        return self.grid_index.adjacent_rooms(room)
 
     def record_percepts(self, sensed_percepts):
         """Update the percepts in agent's KB with the percepts sensed in the
         current location, and update visited_rooms and update all_locs with
         each adjacent location to the current location (since each adjacent
         location to the current location must exist)."""
-        present_percepts = set(p for p in sensed_percepts if p)
-        direction = get_direction(self.degrees)
-        percept_to_process = {
-            "stench": lambda: self.KB.stench.add(self.loc),
-            "breeze": lambda: self.KB.breeze.add(self.loc),
-            "bump": lambda: self.KB.bump.update({self.loc: direction}),
-            "gasp": lambda: setattr(self.KB, "gasp", True),
-            "scream": lambda: setattr(self.KB, "scream", True)
-        }
-        for percept in present_percepts:
-            percept_to_process[percept]()
+        self.record_percept_flags(percepts_to_flags(sensed_percepts))
+
+    def record_percept_flags(self, flags):
+        """Same as record_percepts, but for percepts as the bit flags of
+        utils (as get_percept_flags of the world returns them)."""
+        if flags & STENCH:
+            self.KB.stench.add(self.loc)
+        if flags & BREEZE:
+            self.KB.breeze.add(self.loc)
+        if flags & BUMP:
+            self.KB.bump[self.loc] = get_direction(self.degrees)
+        if flags & GASP:
+            self.KB.gasp = True
+        if flags & SCREAM:
+            self.KB.scream = True
 
         self.KB.visited_rooms.add(self.loc)
         self.KB.all_locs.update(self.adjacent_locs(self.loc))
@@ -94,22 +410,651 @@ class Agent:
         query, and will be checked for consistency with the KB
         to find the model of the KB."""
 
-        is_not_pit_or_wampa = self.KB.walls | self.KB.safe_rooms
-        could_be_pit_or_wampa = self.KB.all_locs - is_not_pit_or_wampa
-        n = len(could_be_pit_or_wampa)
-        return set(
-            (
-                frozenset(pit_rooms) if pit_rooms else frozenset({()}),
-                flatten(wampa_room)
-            )
-            for num_pits in range(n + 1)
-            for num_wampas in range(2)
-            for pit_rooms in comb(could_be_pit_or_wampa, num_pits)
-            for wampa_room in comb(could_be_pit_or_wampa, num_wampas)
-
-            # Exclude cases where wampa overlaps with pit rooms unless empty
-            if flatten(wampa_room) not in pit_rooms or wampa_room == ()
-        )
+        return set(self.iter_possible_worlds())
+
+    def iter_possible_worlds(self):
+        """Lazily yield the same worlds as enumerate_possible_worlds, one at a
+        time, so that the world space never has to be held in memory."""
+        for world in self.iter_possible_world_masks():
+            yield self.decode_world(world)
+
+    def iter_possible_world_masks(self):
+        """Lazily yield every possible world over the candidate rooms as a
+        (pit_mask, wampa_index) tuple. See room_index. Facts already in the
+        KB are fixed instead of branched on (see fix_known_facts)."""
+        could_be_pit_or_wampa = [self.room_index(room)
+                                 for room in self.candidate_rooms()]
+        known_pit_mask = self.rooms_to_mask(self.KB.pits &
+                                            self.candidate_rooms())
+        pit_indices, wampa_indices, _ = self.fix_known_facts(
+            (could_be_pit_or_wampa, [-1] + could_be_pit_or_wampa, []))
+        pit_bits = [1 << index for index in pit_indices]
+        for num_pits in range(len(pit_bits) + 1):
+            for pits in comb(pit_bits, num_pits):
+                pit_mask = sum(pits) | known_pit_mask
+                # Exclude cases where wampa overlaps with pit rooms
+                for wampa_index in wampa_indices:
+                    if wampa_index < 0 or not pit_mask >> wampa_index & 1:
+                        yield pit_mask, wampa_index
+
+    def room_index(self, room):
+        """Return the index of room's bit in a room mask, assigning the next
+        free index to room (and linking it to its indexed neighbours in
+        adjacent_masks) the first time room is seen."""
+        return self.grid_index.index(room)
+
+    def rooms_to_mask(self, rooms):
+        """Return the room mask with the bit of every room in rooms set."""
+        mask = 0
+        for room in rooms:
+            if room != ():
+                mask |= 1 << self.room_index(room)
+        return mask
+
+    def mask_to_rooms(self, mask):
+        """Return the list of rooms whose bit is set in mask."""
+        rooms = []
+        while mask:
+            low_bit = mask & -mask
+            rooms.append(self.index_to_room[low_bit.bit_length() - 1])
+            mask ^= low_bit
+        return rooms
+
+    def encode_world(self, world):
+        """Convert a (pit_rooms, wampa_room) world into (pit_mask,
+        wampa_index), where a wampa_index of -1 means there is no wampa."""
+        pit_rooms, wampa_room = world
+        wampa_index = self.room_index(wampa_room) if wampa_room else -1
+        return self.rooms_to_mask(pit_rooms), wampa_index
+
+    def decode_world(self, world):
+        """Convert a (pit_mask, wampa_index) world back into a (pit_rooms,
+        wampa_room) world."""
+        pit_mask, wampa_index = world
+        pit_rooms = frozenset(self.mask_to_rooms(pit_mask) or [()])
+        wampa_room = self.index_to_room[wampa_index] \
+            if wampa_index >= 0 else ()
+        return pit_rooms, wampa_room
+
+    def KB_state(self):
+        """Return a snapshot of every part of the KB that inference_algorithm
+        reads or updates, to tell whether anything changed between two
+        calls. The location is left out, since every candidate room is
+        inferred about wherever the agent is."""
+        return (frozenset(self.KB.visited_rooms),
+                frozenset(self.KB.breeze), frozenset(self.KB.stench),
+                frozenset(self.KB.all_locs), frozenset(self.KB.safe_rooms),
+                frozenset(self.KB.walls), frozenset(self.KB.pits),
+                self.KB.wampa, self.KB.scream)
+
+    def KB_fingerprint(self):
+        """Return a canonical, hashable fingerprint of everything that the
+        results of inference_algorithm depend on: KB_state and the semantics
+        set by frontier_only (like KB_state, not the location). Unlike room
+        masks, it does not depend on the order in which this agent indexed
+        rooms."""
+        return (self.frontier_only,) + self.KB_state()
+
+    def KB_masks(self):
+        """Return (no_pit_mask, no_wampa_mask, breeze_mask, stench_mask) for
+        the current KB. A room whose bit is set in no_pit_mask (no_wampa_mask)
+        is adjacent to a visited room where breeze (stench) was not
+        perceived, so it cannot be a pit (wampa)."""
+        no_pit_mask = no_wampa_mask = 0
+        for room in self.KB.visited_rooms:
+            adj_mask = self.grid_index.adjacent_mask(room)
+            if room not in self.KB.breeze:
+                no_pit_mask |= adj_mask
+            if room not in self.KB.stench:
+                no_wampa_mask |= adj_mask
+        breeze_mask = self.rooms_to_mask(self.KB.breeze)
+        stench_mask = self.rooms_to_mask(self.KB.stench)
+        return no_pit_mask, no_wampa_mask, breeze_mask, stench_mask
+
+    def candidate_rooms(self):
+        """Return the set of rooms that could potentially have a pit or a
+        wampa, i.e. every known room that is not a wall or known to be
+        safe."""
+        return self.KB.all_locs - (self.KB.walls | self.KB.safe_rooms)
+
+    def frontier_rooms(self):
+        """Return the candidate rooms that are adjacent to a visited room
+        where breeze or stench was perceived. No percept constrains the other
+        candidate rooms."""
+        perceived = self.KB.breeze | self.KB.stench
+        return {room for room in self.candidate_rooms()
+                if self.adjacent_locs(room) & perceived}
+
+    def world_space(self, masks):
+        """Return (pit_indices, wampa_indices, breeze_adjacent_masks), given
+        masks from KB_masks. The worlds to check are every subset of the
+        rooms in pit_indices combined with every wampa_index in wampa_indices
+        (-1 for no wampa) that does not overlap with it. A world must also
+        have a pit in each room mask of breeze_adjacent_masks.
+
+        If frontier_only is set, only frontier rooms that could be a pit (or
+        the wampa) on their own are branched on, and a pit must be adjacent
+        to every room where breeze was perceived. A wampa_index of -1 then
+        means that there is no wampa in the frontier. Otherwise, every
+        candidate room is branched on, and there must be some pit if breeze
+        was perceived. Either way, the facts already in the KB are fixed
+        (see fix_known_facts)."""
+        no_pit_mask, _, breeze_mask, _ = masks
+        if not self.frontier_only:
+            could_be_pit_or_wampa = [self.room_index(room)
+                                     for room in self.candidate_rooms()]
+            some_pit = [sum(1 << index for index in could_be_pit_or_wampa)]
+            return self.fix_known_facts(
+                (could_be_pit_or_wampa, [-1] + could_be_pit_or_wampa,
+                 some_pit if breeze_mask else []))
+
+        frontier = [self.room_index(room) for room in self.frontier_rooms()]
+        pit_indices = [index for index in frontier
+                       if not no_pit_mask >> index & 1]
+        wampa_mask = self.wampa_mask()
+        wampa_indices = [index for index in frontier
+                         if wampa_mask >> index & 1]
+        if not masks[3]:
+            wampa_indices.insert(0, -1)
+        breeze_adjacent_masks = [self.adjacent_masks[index] for index in
+                                 range(breeze_mask.bit_length())
+                                 if breeze_mask >> index & 1]
+        return self.fix_known_facts(
+            (pit_indices, wampa_indices, breeze_adjacent_masks))
+
+    def fix_known_facts(self, space):
+        """Return space (see world_space) without the dimensions that the KB
+        already settles. Known pits are in every world, so they are not
+        branched on and the breeze rules they satisfy are dropped. The wampa
+        is not in a known pit, and is only in its known room or, once it is
+        dead, nowhere."""
+        pit_indices, wampa_indices, breeze_adjacent_masks = space
+        known_pit_mask = self.rooms_to_mask(self.KB.pits)
+        if self.KB.scream:
+            wampa_indices = [-1]
+        elif self.KB.wampa:
+            wampa_indices = [self.room_index(self.KB.wampa)]
+        return ([index for index in pit_indices
+                 if not known_pit_mask >> index & 1],
+                [index for index in wampa_indices
+                 if index < 0 or not known_pit_mask >> index & 1],
+                [adj_mask for adj_mask in breeze_adjacent_masks
+                 if not adj_mask & known_pit_mask])
+
+    def free_pit_indices(self, space, masks):
+        """Return the pit rooms of space (see world_space) that are not ruled
+        out as pits by the rooms without breeze, given masks from
+        KB_masks."""
+        return [index for index in space[0] if not masks[0] >> index & 1]
+
+    def iter_pit_model(self, space, masks):
+        """Lazily yield the pit_mask of every subset of the pit rooms of space
+        (see world_space) that is consistent with KB, given masks from
+        KB_masks. Breeze only depends on pits, so this does not depend on
+        where the wampa is. See iter_gray_pit_masks.
+
+        Subsets are enumerated in chunks, and enumeration stops (setting
+        finished to False) once the budget of the inference is spent."""
+        breeze_adjacent_masks = space[2]
+        pit_indices = self.free_pit_indices(space, masks)
+        num_steps = 2 ** len(pit_indices)
+        for start in range(0, num_steps, 4096):
+            stop = min(start + 4096, num_steps)
+            if self.budget_is_spent(stop - start):
+                self.finished = False
+                return
+            yield from iter_gray_pit_masks(pit_indices, breeze_adjacent_masks,
+                                           start, stop)
+
+    def budget_is_spent(self, num_worlds):
+        """Count num_worlds more pit subsets as enumerated, and return True if
+        that goes over the world budget or if the deadline has passed."""
+        self.worlds_checked += num_worlds
+        if self.world_budget is not None and \
+                self.worlds_checked > self.world_budget:
+            return True
+        return self.deadline is not None and perf_counter() > self.deadline
+
+    def pit_model(self, space, masks):
+        """Return the pit masks of iter_pit_model. If incremental is set, they
+        are returned as a list that is kept between calls in kept_models and
+        reused by later calls whose pit rooms are a subset of the kept ones
+        (see kept_pit_model): the kept list is filtered by the new knowledge
+        instead of being enumerated again. Otherwise they are streamed."""
+        if not self.incremental:
+            return self.iter_pit_model(space, masks)
+        pit_indices, _, breeze_adjacent_masks = space
+        no_pit_mask = masks[0]
+        room_mask = sum(1 << index for index in pit_indices)
+
+        kept = self.kept_pit_model(room_mask, breeze_adjacent_masks,
+                                   no_pit_mask)
+        if kept is not None:
+            old_room_mask, pit_masks = kept
+            # worlds with a pit in a room that left the component are not
+            # worlds of the component any more
+            not_pit_mask = no_pit_mask | old_room_mask & ~room_mask
+            pit_masks = [pit_mask for pit_mask in pit_masks
+                         if not pit_mask & not_pit_mask and
+                         all(adj_mask & pit_mask
+                             for adj_mask in breeze_adjacent_masks)]
+        else:
+            pit_masks = list(self.iter_pit_model(space, masks))
+            if not self.finished:
+                # cut short by the budget, here or in an earlier component:
+                # not the whole pit model, so not kept
+                return pit_masks
+
+        self.kept_models[(self.frontier_only, room_mask)] = (
+            no_pit_mask, tuple(adj_mask & room_mask
+                               for adj_mask in breeze_adjacent_masks),
+            pit_masks)
+        return pit_masks
+
+    def kept_pit_model(self, room_mask, breeze_adjacent_masks, no_pit_mask):
+        """Return (room mask, pit masks) of the smallest kept pit model that
+        still holds every world of the pit rooms in room_mask, or None.
+
+        A kept model over a superset of the rooms holds every such world as
+        long as the KB has only grown since it was kept: the rooms it kept
+        free of pits still are, and each of its breeze rules is implied by a
+        new one, which is not the case when a rule was dropped because a
+        room next to the breeze turned out to be a pit."""
+        best = None
+        for (frontier_only, old_room_mask), (old_no_pit_mask, old_rules,
+                                             pit_masks) \
+                in self.kept_models.items():
+            if frontier_only != self.frontier_only or \
+                    room_mask & ~old_room_mask or \
+                    old_no_pit_mask & ~no_pit_mask:
+                continue
+            if best is not None and \
+                    bin(old_room_mask).count("1") >= bin(best[0]).count("1"):
+                continue
+            if all(any(not adj_mask & room_mask & ~rule
+                       for adj_mask in breeze_adjacent_masks)
+                   for rule in old_rules):
+                best = old_room_mask, pit_masks
+        return best
+
+    def pit_components(self, space):
+        """Split space (see world_space) into sub-spaces whose pit rooms share
+        no breeze rule with each other, so that the pit model of space is
+        made of every union of one pit_mask from the pit model of each
+        sub-space. Return None if some breeze rule has no pit room left."""
+        pit_indices, wampa_indices, breeze_adjacent_masks = space
+        pit_space_mask = sum(1 << index for index in pit_indices)
+        components = []  # [(room mask, breeze_adjacent_masks)]
+        for adj_mask in breeze_adjacent_masks:
+            room_mask, rules = adj_mask & pit_space_mask, [adj_mask]
+            if not room_mask:
+                return None
+            unlinked = []
+            for component in components:
+                if component[0] & room_mask:
+                    room_mask |= component[0]
+                    rules += component[1]
+                else:
+                    unlinked.append(component)
+            components = unlinked + [(room_mask, rules)]
+
+        linked_mask = 0
+        for room_mask, _ in components:
+            linked_mask |= room_mask
+        components += [(1 << index, []) for index in pit_indices
+                       if not linked_mask >> index & 1]
+        return [([index for index in pit_indices if room_mask >> index & 1],
+                 wampa_indices, rules)
+                for room_mask, rules in components]
+
+    def wampa_mask(self):
+        """Return the room mask of every room that can be the wampa given the
+        stench percepts alone: rooms adjacent to every room with stench and
+        to no visited room without stench (-1, any room, if there are no such
+        rooms). The mask is kept in kept_wampa and only updated with the
+        rooms visited since the previous call, unless stench was cleared."""
+        seen, seen_stench, mask = self.kept_wampa
+        rooms = self.KB.visited_rooms | self.KB.stench
+        if not seen <= rooms or seen_stench != self.KB.stench & seen:
+            seen, mask = set(), -1
+        for room in rooms - seen:
+            adj_mask = self.grid_index.adjacent_mask(room)
+            mask &= adj_mask if room in self.KB.stench else ~adj_mask
+        self.kept_wampa = (rooms, self.KB.stench & rooms, mask)
+        return mask
+
+    def wampa_model(self, space, masks):
+        """Return the list of wampa_index of space (see world_space) that are
+        consistent with KB, given masks from KB_masks. Stench only depends on
+        the wampa, so this does not depend on where the pits are."""
+        wampa_mask = self.wampa_mask()
+        return [index for index in space[1]
+                if (wampa_mask >> index & 1 if index >= 0 else not masks[3])]
+
+    def iter_model_of_world_space(self, space, masks):
+        """Lazily yield the (pit_mask, wampa_index) worlds of space (see
+        world_space) that are consistent with KB, given masks from KB_masks,
+        by combining the pit and wampa models wherever they do not
+        overlap."""
+        wampa_indices = self.wampa_model(space, masks)
+        for pit_mask in self.pit_model(space, masks):
+            for wampa_index in wampa_indices:
+                if wampa_index < 0 or not pit_mask >> wampa_index & 1:
+                    yield pit_mask, wampa_index
+
+    def numpy_pit_model(self, space, masks):
+        """Same as iter_pit_model, but return a boolean matrix with a row per
+        pit_mask and a column per room in pit_indices (True for a pit). Only
+        the rooms that KB does not rule out as pits are enumerated."""
+        if np is None:
+            raise ImportError("The numpy backend requires numpy.")
+        pit_indices, _, breeze_adjacent_masks = space
+        free_indices = self.free_pit_indices(space, masks)
+        n = len(free_indices)
+
+        # a row per subset of the free rooms: the bits of its number,
+        # unpacked from its little-endian bytes, a byte per cell
+        subsets = np.arange(2 ** n, dtype="<u8").view(np.uint8).reshape(-1, 8)
+        free_pits = np.unpackbits(subsets[:, :(n + 7) // 8], axis=1,
+                                  bitorder="little")[:, :n].view(bool)
+        if breeze_adjacent_masks:
+            breeze_adjacent = np.array([[adj_mask >> index & 1
+                                         for adj_mask in breeze_adjacent_masks]
+                                        for index in free_indices],
+                                       dtype=bool)
+            breeze_adjacent = breeze_adjacent.reshape(
+                n, len(breeze_adjacent_masks))
+            free_pits = free_pits[(free_pits @ breeze_adjacent).all(axis=1)]
+        if n == len(pit_indices):
+            return free_pits
+        column = {index: j for j, index in enumerate(pit_indices)}
+        pits = np.zeros((len(free_pits), len(pit_indices)), dtype=bool)
+        pits[:, [column[index] for index in free_indices]] = free_pits
+        return pits
+
+    def numpy_pit_summaries(self, space, masks, wampa_indices):
+        """Same as summarize_pit_masks over the pit model of space, but from
+        the matrix of numpy_pit_model, which counts against the budget of
+        the inference as a whole (if it is spent, finished is set to
+        False)."""
+        summaries = dict.fromkeys([-1] + list(wampa_indices), (-1, 0, False))
+        pit_indices = space[0]
+        if self.budget_is_spent(2 ** len(self.free_pit_indices(space,
+                                                               masks))):
+            self.finished = False
+            return summaries
+        pits = self.numpy_pit_model(space, masks)
+        column = {index: j for j, index in enumerate(pit_indices)}
+        for wampa_index in summaries:
+            rows = pits if wampa_index < 0 else \
+                pits[~pits[:, column[wampa_index]]]
+            if len(rows):
+                summaries[wampa_index] = (
+                    sum(1 << pit_indices[j]
+                        for j in np.flatnonzero(rows.all(axis=0))),
+                    sum(1 << pit_indices[j]
+                        for j in np.flatnonzero(rows.any(axis=0))),
+                    True)
+        return summaries
+
+    def numpy_wampa_overlaps(self, pits, space, wampa):
+        """Return a boolean matrix with a row per row of pits and a column per
+        wampa_index in wampa, True where that wampa room is a pit."""
+        column = {index: j for j, index in enumerate(space[0])}
+        wampa_column = [column.get(index, len(column)) for index in wampa]
+        # a wampa room that is not a pit room maps to an all-False column
+        padded_pits = np.hstack([pits, np.zeros((len(pits), 1), dtype=bool)])
+        return padded_pits[:, wampa_column]
+
+    def numpy_model_of_world_space(self, space, masks):
+        """Return the worlds of space (see world_space) that are consistent
+        with KB, given masks from KB_masks, as a boolean matrix with a row per
+        world and a column per room in pit_indices (True where the world has
+        a pit) and a vector of the wampa_index of each world."""
+        pits = self.numpy_pit_model(space, masks)
+        wampa = np.array(self.wampa_model(space, masks), dtype=np.int64)
+        overlaps = self.numpy_wampa_overlaps(pits, space, wampa).ravel()
+        pits = np.repeat(pits, len(wampa), axis=0)
+        wampa = np.tile(wampa, len(pits) // max(len(wampa), 1))
+        return pits[~overlaps], wampa[~overlaps]
+
+    def python_model_summary(self, space, masks):
+        """Return (all_pits, any_pits, wampa_indices, model_is_empty) for the
+        model of the KB over space (see world_space), given masks from
+        KB_masks. all_pits (any_pits) is the mask of rooms that have a pit in
+        every (some) world of the model, and wampa_indices is the set of
+        wampa_index over the worlds of the model.
+
+        If factorized is set, the pit and wampa models are summarized
+        separately and only combined through the rule that the wampa is not
+        in a pit room. The pit model is also split into independent
+        components (see pit_components) if decompose is set. Otherwise every
+        world of the model is gone through in a single pass that stops as
+        soon as the summary cannot change.
+
+        If the budget of the inference runs out, the pit models that were
+        not enumerated in full are summarized by unknown_model_summary."""
+        if self.factorized:
+            components = self.pit_components(space) if self.decompose \
+                else [space]
+            if components is None:
+                return -1, 0, set(), True
+            kept_models = set(self.kept_models)
+            summary = self.factorized_model_summary(
+                components, self.wampa_model(space, masks), masks)
+            for key in kept_models - {(self.frontier_only, sum(
+                    1 << index for index in component[0]))
+                    for component in components}:
+                del self.kept_models[key]
+            return summary
+
+        pit_indices, wampa_indices, _ = space
+        pit_space_mask = sum(1 << index for index in pit_indices)
+        num_wampa_indices = len(self.wampa_model(space, masks))
+        all_pits, any_pits, seen_wampa_indices = -1, 0, set()
+        for pit_mask, wampa_index in self.iter_model_of_world_space(space,
+                                                                    masks):
+            all_pits &= pit_mask
+            any_pits |= pit_mask
+            seen_wampa_indices.add(wampa_index)
+            if not all_pits and any_pits == pit_space_mask and \
+                    len(seen_wampa_indices) == num_wampa_indices:
+                break
+        if not self.finished:
+            return self.unknown_model_summary(space, masks)
+        return all_pits, any_pits, seen_wampa_indices, all_pits == -1
+
+    def unknown_model_summary(self, space, masks):
+        """Return the summary of python_model_summary that only assumes what
+        holds in every world of space (see world_space) on its own: no pit
+        is certain, any pit room may be a pit and any room of the wampa
+        model may be the wampa. Any query it entails is entailed by the
+        KB."""
+        return (0, sum(1 << index for index in space[0]) & ~masks[0],
+                set(self.wampa_model(space, masks)), False)
+
+    def factorized_model_summary(self, components, wampa_indices, masks):
+        """Return the summary of python_model_summary given the sub-spaces of
+        pit_components and the wampa model wampa_indices, with one pass over
+        the pit model of each sub-space.
+
+        A pit_mask is part of the model of the KB if some wampa room is not a
+        pit in it, and a wampa room is if some pit_mask has no pit there.
+        Only the component with the wampa room in it has to be summarized
+        again without a pit there.
+
+        If incremental is set, the summaries of each component are kept in
+        kept_summaries, keyed by everything they depend on: its pit rooms,
+        its breeze rules, the rooms of it next to a room without breeze and
+        its wampa rooms. So the verdicts about the rooms of a component are
+        only worked out again once a percept arrives in a room next to it
+        (or the wampa model changes there)."""
+        wampa_rooms = {index for index in wampa_indices if index >= 0}
+        all_pits, any_pits = 0, 0
+        component_summaries = dict()  # {wampa_index: (room mask, summary)}
+        kept_summaries = dict()
+        for component in components:
+            pit_indices = component[0]
+            room_mask = sum(1 << index for index in pit_indices)
+            wampa_in_component = [index for index in pit_indices
+                                  if index in wampa_rooms]
+            key = (tuple(pit_indices), tuple(sorted(component[2])),
+                   masks[0] & room_mask, tuple(wampa_in_component))
+            if self.incremental and key in self.kept_summaries:
+                summaries = self.kept_summaries[key]
+            else:
+                summaries = self.component_summaries(
+                    component, masks, wampa_in_component)
+            if self.incremental and (self.finished or
+                                     key in self.kept_summaries):
+                kept_summaries[key] = summaries
+            summaries = dict(summaries)
+            every, some, is_consistent = summaries.pop(-1)
+            if not is_consistent:  # no world of the model is left
+                return -1, 0, set(), True
+            all_pits |= every
+            any_pits |= some
+            component_summaries.update(
+                (wampa_index, (room_mask, summary))
+                for wampa_index, summary in summaries.items())
+        self.kept_summaries = kept_summaries
+
+        if -1 in wampa_indices:
+            wampa_summaries = {-1: (all_pits, any_pits)}
+        else:
+            wampa_summaries = dict()
+        for wampa_index in wampa_rooms:
+            if wampa_index not in component_summaries:
+                wampa_summaries[wampa_index] = (all_pits, any_pits)
+                continue
+            room_mask, (every, some, is_consistent) = \
+                component_summaries[wampa_index]
+            if is_consistent:
+                wampa_summaries[wampa_index] = (
+                    all_pits & ~room_mask | every,
+                    any_pits & ~room_mask | some)
+        if not wampa_summaries:
+            return -1, 0, set(), True
+
+        all_pits, any_pits = -1, 0
+        for every, some in wampa_summaries.values():
+            all_pits &= every
+            any_pits |= some
+        return all_pits, any_pits, set(wampa_summaries), False
+
+    def component_summaries(self, component, masks, wampa_indices):
+        """Return summarize_pit_masks over the pit model of component (a
+        sub-space of pit_components): with numpy if that is the backend and
+        it has at most numpy_max_rooms pit rooms, or across processes if it
+        has at least parallel_threshold pit rooms. If the budget of the
+        inference runs out, every summary only assumes that any pit_mask may
+        be left."""
+        pit_indices = component[0]
+        if self.backend == "numpy" and \
+                len(pit_indices) <= self.numpy_max_rooms:
+            summaries = self.numpy_pit_summaries(component, masks,
+                                                 wampa_indices)
+        elif self.processes and len(pit_indices) >= self.parallel_threshold:
+            summaries = self.parallel_pit_summaries(component, masks,
+                                                    wampa_indices)
+        else:
+            summaries = summarize_pit_masks(
+                self.pit_model(component, masks), wampa_indices)
+        if self.finished:
+            return summaries
+        can_be_pit = sum(1 << index for index in pit_indices) & ~masks[0]
+        return {wampa_index: (0, can_be_pit & ~(1 << wampa_index)
+                              if wampa_index >= 0 else can_be_pit, True)
+                for wampa_index in summaries}
+
+    def parallel_pit_summaries(self, space, masks, wampa_indices):
+        """Same as summarize_pit_masks over the pit model of space, but with
+        the Gray code order split into ranges that are summarized across a
+        pool of self.processes worker processes (see process_pool) and then
+        merged.
+
+        The budget of the inference is checked before each range is waited
+        for. Once it is spent, finished is set to False and the ranges that
+        have not started are cancelled. The pool is shut down without waiting
+        for the ranges still running, so that they do not hold up the next
+        inference."""
+        breeze_adjacent_masks = space[2]
+        pit_indices = self.free_pit_indices(space, masks)
+        num_steps = 2 ** len(pit_indices)
+        num_ranges = 4 * self.processes
+        bounds = [num_steps * i // num_ranges for i in range(num_ranges + 1)]
+
+        summaries = dict.fromkeys([-1] + list(wampa_indices),
+                                  (-1, 0, False))
+        if not self.finished:
+            return summaries
+        pool = self.process_pool()
+        ranges = list(zip(bounds, bounds[1:]))
+        futures = [pool.submit(summarize_pit_range, pit_indices,
+                               breeze_adjacent_masks, wampa_indices,
+                               start, stop)
+                   for start, stop in ranges]
+        for future, (start, stop) in zip(futures, ranges):
+            timeout = None if self.deadline is None else \
+                max(self.deadline - perf_counter(), 0)
+            if self.budget_is_spent(stop - start) or \
+                    not wait([future], timeout).done:
+                self.finished = False
+                break
+            for wampa_index, (every, some, is_consistent) in \
+                    future.result().items():
+                if is_consistent:
+                    old_every, old_some, _ = summaries[wampa_index]
+                    summaries[wampa_index] = (old_every & every,
+                                              old_some | some, True)
+        if not self.finished:
+            self.shutdown_pool(wait=False)
+        return summaries
+
+    def process_pool(self):
+        """Return the pool of self.processes worker processes, which is
+        started the first time it is needed and kept between inferences in
+        kept_pool (a new one is started if processes changed). Call
+        shutdown_pool to stop its workers."""
+        if self.kept_pool is None or self.kept_pool[0] != self.processes:
+            self.shutdown_pool()
+            self.kept_pool = (self.processes,
+                              ProcessPoolExecutor(self.processes))
+        return self.kept_pool[1]
+
+    def shutdown_pool(self, wait=True):
+        """Stop the workers of the pool of process_pool, if any, cancelling
+        the work that has not started. If wait is False, do not wait for the
+        work that is running."""
+        if self.kept_pool is not None:
+            self.kept_pool[1].shutdown(wait=wait, cancel_futures=True)
+            self.kept_pool = None
+
+    def numpy_model_summary(self, space, masks):
+        """Same as python_model_summary, but the models are held in boolean
+        matrices and the summary is made of vectorized reductions.
+
+        If factorized is set, this is python_model_summary itself, which
+        summarizes the pit model of each component with numpy_pit_summaries
+        (see component_summaries). Otherwise, a space with more than
+        numpy_max_rooms free pit rooms (see free_pit_indices) is left to
+        python_model_summary, since its matrix would have a row per subset
+        of them."""
+        num_free = len(self.free_pit_indices(space, masks))
+        if self.factorized or num_free > self.numpy_max_rooms:
+            return self.python_model_summary(space, masks)
+        if self.budget_is_spent(2 ** num_free):
+            self.finished = False
+            return self.unknown_model_summary(space, masks)
+        pits, wampa = self.numpy_model_of_world_space(space, masks)
+        if not len(pits) or not len(wampa):
+            return -1, 0, set(), True
+        pit_indices = space[0]
+        all_pits = sum(1 << pit_indices[j]
+                       for j in np.flatnonzero(pits.all(axis=0)))
+        any_pits = sum(1 << pit_indices[j]
+                       for j in np.flatnonzero(pits.any(axis=0)))
+        return all_pits, any_pits, set(np.unique(wampa).tolist()), False
 
     def pit_room_is_consistent_with_KB(self, room):
         """Return True if the room could be a pit given breeze in KB, False
@@ -120,8 +1065,8 @@ class Agent:
         if room == ():  # It is possible that there are no pits
             return not self.KB.breeze  # if no breeze has been perceived yet
 
-        return all(room in self.KB.breeze or room not in self.KB.visited_rooms
-                   for room in self.adjacent_locs(room))
+        return self.pits_are_consistent(self.rooms_to_mask([room]),
+                                        self.KB_masks())
 
     def wampa_room_is_consistent_with_KB(self, room):
         """Return True if the room could be a wampa given stench in KB, False
@@ -131,17 +1076,27 @@ class Agent:
         A room cannot be a wampa if any adjacent rooms that have been visited
         have not had stench perceived in them.
         This will be used to find the model of the KB."""
-        if room == ():  # It is possible that there is no Wampa
-            return not self.KB.stench  # if no stench has been perceived yet
+        wampa_index = self.room_index(room) if room else -1
+        return self.wampa_is_consistent(wampa_index, self.KB_masks())
 
-        all_adj_rooms_have_stench = all(r in self.KB.stench or
-                                        r not in self.KB.visited_rooms
-                                        for r in self.adjacent_locs(room))
+    def pits_are_consistent(self, pit_mask, masks):
+        """Return True if every pit in pit_mask is consistent with the KB,
+        given masks from KB_masks. No pits are consistent only if no breeze
+        has been perceived yet."""
+        no_pit_mask, _, breeze_mask, _ = masks
+        if not pit_mask:
+            return not breeze_mask
+        return not pit_mask & no_pit_mask
 
-        all_stench_is_adjacent = all(stench_room in self.adjacent_locs(room)
-                                     for stench_room in self.KB.stench)
-
-        return all_adj_rooms_have_stench and all_stench_is_adjacent
+    def wampa_is_consistent(self, wampa_index, masks):
+        """Return True if the wampa in wampa_index (-1 for no wampa) is
+        consistent with the KB, given masks from KB_masks."""
+        _, no_wampa_mask, _, stench_mask = masks
+        if wampa_index < 0:
+            return not stench_mask
+        adj_mask = self.adjacent_masks[wampa_index]
+        return not no_wampa_mask >> wampa_index & 1 and \
+            adj_mask & stench_mask == stench_mask
 
     def find_model_of_KB(self, possible_worlds):
         """Return the subset of all possible worlds consistent with KB.
@@ -151,44 +1106,458 @@ class Agent:
         A world is consistent with the KB if the wampa location is consistent
         and all pit rooms are consistent with the KB."""
 
-        return {(p, w) for p, w in possible_worlds if
-                self.wampa_room_is_consistent_with_KB(w) and
-                (all(self.pit_room_is_consistent_with_KB(room) for room in p))}
+        return set(self.iter_model_of_KB(possible_worlds))
+
+    def iter_model_of_KB(self, possible_worlds):
+        """Lazily yield the worlds of possible_worlds (any iterable, e.g.
+        iter_possible_worlds()) that are consistent with the KB."""
+        encoded_worlds = ((world, self.encode_world(world))
+                          for world in possible_worlds)
+        masks = self.KB_masks()
+        for world, (pit_mask, wampa_index) in encoded_worlds:
+            if self.wampa_is_consistent(wampa_index, masks) and \
+                    self.pits_are_consistent(pit_mask, masks):
+                yield world
 
     def find_model_of_query(self, query, room, possible_worlds):
         """Where query can be "pit_in_room", "wampa_in_room", "no_pit_in_room"
         or "no_wampa_in_room", filter the set of possible worlds
         according to the query and room."""
-        query_to_filter = {
-            "pit_in_room": lambda world: room in world[0],
-            "wampa_in_room": lambda world: room == world[1],
-            "no_pit_in_room": lambda world: room not in world[0],
-            "no_wampa_in_room": lambda world: room != world[1]
+        room_index = self.room_index(room)
+        return {world for world in possible_worlds
+                if self.query_holds(query, room_index,
+                                    self.encode_world(world))}
+
+    def query_holds(self, query, room_index, world):
+        """Return True if query about the room in room_index is true in the
+        (pit_mask, wampa_index) world."""
+        pit_mask, wampa_index = world
+        query_to_value = {
+            "pit_in_room": lambda: pit_mask >> room_index & 1,
+            "wampa_in_room": lambda: wampa_index == room_index,
+            "no_pit_in_room": lambda: not pit_mask >> room_index & 1,
+            "no_wampa_in_room": lambda: wampa_index != room_index
         }
-        filter_function = query_to_filter.get(query)
-        return set(filter(filter_function, possible_worlds))
+        return bool(query_to_value[query]())
 
     def infer_wall_locations(self):
-        """If a bump is perceived, infer wall locations along the entire known
-        length of the room."""
-        if not self.KB.bump:
-            return
-        room, orientation = self.KB.bump.popitem()
-        dx, dy = self.orientation_to_delta[orientation]
-
-        min_x = min(self.KB.all_locs, key=lambda loc: loc[0])[0]
-        max_x = max(self.KB.all_locs, key=lambda loc: loc[0])[0]
-        min_y = min(self.KB.all_locs, key=lambda loc: loc[1])[1]
-        max_y = max(self.KB.all_locs, key=lambda loc: loc[1])[1]
-        _min = {"up": min_x, "down": min_x, "left": min_y, "right": min_y}
-        _max = {"up": max_x, "down": max_x, "left": max_y, "right": max_y}
-
-        for i in range(_min[orientation], _max[orientation] + 1):
-            wall = {"up": (i, room[1] + dy), "down": (i, room[1] + dy),
-                    "left": (room[0] + dx, i), "right": (room[0] + dx, i)}
-            self.KB.walls.add(wall[orientation])
-
-    def inference_algorithm(self):
+        """If a bump is perceived, infer the bound of the cave in that
+        direction (see KB.bounds), for every bump perceived since the last
+        call. Each known room beyond a bound is a wall: it is added to
+        KB.walls and dropped from KB.all_locs, since it cannot exist. Unless
+        a new bound was found, only the rooms adjacent to the current
+        location can be new beyond the bounds."""
+        rooms = self.KB.all_locs if self.KB.bump else \
+            self.adjacent_locs(self.loc) & self.KB.all_locs
+        while self.KB.bump:
+            room, direction = self.KB.bump.popitem()
+            orientation = ORIENTATIONS.index(direction)
+            dx, dy = ORIENTATION_DELTAS[orientation]
+            self.KB.bounds[orientation] = room[0] if dx else room[1]
+
+        walls = {room for room in rooms if self.is_beyond_bounds(room)}
+        self.KB.walls.update(walls)
+        self.KB.all_locs -= walls
+
+    def is_beyond_bounds(self, room):
+        """Return True if room is beyond a known bound of the cave."""
+        for orientation, bound in self.KB.bounds.items():
+            dx, dy = ORIENTATION_DELTAS[orientation]
+            # how far room is in that direction, compared to the bound
+            if dx * (room[0] - bound) + dy * (room[1] - bound) > 0:
+                return True
+        return False
+
+    def sat_model_summary(self, space, masks, room_indices):
+        """Same as python_model_summary, but only for the rooms in
+        room_indices and decided with a SAT solver instead of enumerating
+        the model of the KB. The KB over space is encoded as CNF, and each
+        query is entailed if the KB is unsatisfiable together with the
+        negation of the query.
+
+        Each call to the solver counts as one world of the budget of the
+        inference. Once it is spent, finished is set to False and the
+        queries left are not entailed."""
+        pit_indices, _, breeze_adjacent_masks = space
+        no_pit_mask = masks[0]
+        wampa_indices = self.wampa_model(space, masks)
+        pit_var = {index: var for var, index in enumerate(pit_indices, 1)}
+        wampa_var = {index: var for var, index in
+                     enumerate([i for i in wampa_indices if i >= 0],
+                               len(pit_var) + 1)}
+        wampa_vars = list(wampa_var.values())
+
+        # pit rules: no pit next to a visited room without breeze, and a pit
+        # in each room mask of breeze_adjacent_masks
+        clauses = [[-var] for index, var in pit_var.items()
+                   if no_pit_mask >> index & 1]
+        for adj_mask in breeze_adjacent_masks:
+            clauses.append([var for index, var in pit_var.items()
+                            if adj_mask >> index & 1])
+
+        # wampa rules: at most one wampa room (with sequential counter
+        # variables), at least one unless there may be no wampa, and no
+        # wampa in a pit room
+        if -1 not in wampa_indices:
+            clauses.append(wampa_vars)
+        num_vars = len(pit_var) + len(wampa_vars)
+        for i, var in enumerate(wampa_vars[:-1]):
+            counter = num_vars + i + 1
+            clauses.append([-var, counter])
+            if i:
+                clauses.append([-(counter - 1), counter])
+            clauses.append([-wampa_vars[i + 1], -counter])
+        num_vars += max(len(wampa_vars) - 1, 0)
+        clauses.extend([-var, -pit_var[index]]
+                       for index, var in wampa_var.items()
+                       if index in pit_var)
+
+        solver = SATSolver(num_vars, clauses)
+        models = []
+
+        def is_satisfiable(assumptions):
+            # a model found earlier often already satisfies assumptions
+            for model in models:
+                if all(model[abs(lit)] == (1 if lit > 0 else -1)
+                       for lit in assumptions):
+                    return True
+            if not self.finished or self.budget_is_spent(1):
+                self.finished = False
+                return None  # not known either way
+            model = solver.solve(assumptions)
+            if model is not None:
+                models.append(model)
+            return model is not None
+
+        is_consistent = is_satisfiable([])
+        if is_consistent is None:
+            return self.unknown_model_summary(space, masks)
+        if not is_consistent:
+            return -1, 0, set(), True
+        all_pits = any_pits = 0
+        for index in room_indices:
+            if index in pit_var and \
+                    is_satisfiable([-pit_var[index]]) is False:
+                all_pits |= 1 << index
+            if index in pit_var and \
+                    is_satisfiable([pit_var[index]]) is not False:
+                any_pits |= 1 << index
+        wampa_indices = {index for index in wampa_indices
+                         if is_satisfiable([wampa_var[index]] if index >= 0
+                                           else [-var for var in wampa_vars])
+                         is not False}
+        return all_pits, any_pits, wampa_indices, False
+
+    def model_summary(self, space, masks, room_indices):
+        """Return the summary of the model of the KB over space (see
+        python_model_summary) from the inference backend."""
+        if self.backend == "numpy":
+            return self.numpy_model_summary(space, masks)
+        if self.backend == "sat":
+            return self.sat_model_summary(space, masks, room_indices)
+        return self.python_model_summary(space, masks)
+
+    def propagated_model_summary(self, space, masks, room_indices):
+        """Same as python_model_summary, but derived by unit propagation over
+        space (see world_space) instead of going through the model of the
+        KB. Return None if propagation does not decide every query about the
+        rooms in room_indices.
+
+        A breeze rule with a single room left that can be a pit forces a pit
+        there, which rules out the wampa in it, and a single wampa room left
+        rules out a pit in it. The model is empty if a rule or the wampa
+        rooms run out, or if no wampa room leaves enough pits: the most pits
+        that any world can have are all pit rooms except the wampa room."""
+        pit_indices, _, breeze_adjacent_masks = space
+        wampa_indices = self.wampa_model(space, masks)
+        can_be_pit = sum(1 << index for index in pit_indices) & ~masks[0]
+        pits = 0
+        while True:
+            wampa_indices = [index for index in wampa_indices
+                             if index < 0 or not pits >> index & 1]
+            if not wampa_indices:
+                return -1, 0, set(), True
+            if wampa_indices[0] >= 0 and len(wampa_indices) == 1:
+                can_be_pit &= ~(1 << wampa_indices[0])
+            forced_pits = pits
+            for adj_mask in breeze_adjacent_masks:
+                rooms_left = adj_mask & can_be_pit
+                if not rooms_left:
+                    return -1, 0, set(), True
+                if not rooms_left & (rooms_left - 1):  # a single room
+                    forced_pits |= rooms_left
+            if forced_pits == pits:
+                break
+            pits = forced_pits
+
+        for index in wampa_indices:
+            most_pits = can_be_pit & ~(1 << index) if index >= 0 \
+                else can_be_pit
+            if all(adj_mask & most_pits for adj_mask in breeze_adjacent_masks):
+                break
+        else:
+            return -1, 0, set(), True
+        for room_index in room_indices:
+            if can_be_pit >> room_index & 1 and not pits >> room_index & 1:
+                return None
+            if room_index in wampa_indices and len(wampa_indices) > 1:
+                return None
+        return pits, pits, set(wampa_indices), False
+
+    def sample_risks(self):
+        """Return {room: (pit probability, wampa probability)} for every
+        candidate room, estimated from num_samples worlds of the model of the
+        KB, or None if the model is empty. Each room has a pit with
+        probability pit_prior a priori, and the wampa is in any room of the
+        wampa model with the same probability.
+
+        Worlds are drawn by Gibbs sampling from the world with the most pits
+        in it: a pit room is redrawn from the prior unless that would leave
+        a breeze rule without a pit, and the wampa is redrawn among the
+        rooms of the wampa model without a pit. Rooms outside of world_space
+        can hold a pit with probability pit_prior, and share the chance of
+        there being no wampa in world_space between them."""
+        masks = self.KB_masks()
+        space = self.world_space(masks)
+        pit_indices, _, breeze_adjacent_masks = space
+        pit_indices = [index for index in pit_indices
+                       if not masks[0] >> index & 1]
+        wampa_indices = self.wampa_model(space, masks)
+        for wampa_index in wampa_indices:
+            pit_mask = sum(1 << index for index in pit_indices
+                           if index != wampa_index)
+            if all(adj_mask & pit_mask for adj_mask in breeze_adjacent_masks):
+                break
+        else:
+            return None
+        rules_of_room = [[rule for rule, adj_mask in
+                          enumerate(breeze_adjacent_masks)
+                          if adj_mask >> index & 1]
+                         for index in pit_indices]
+        num_adjacent_pits = [bin(adj_mask & pit_mask).count("1")
+                             for adj_mask in breeze_adjacent_masks]
+
+        rng = Random(self.sample_seed)
+        num_pits = dict.fromkeys(pit_indices, 0)
+        num_wampas = dict.fromkeys(wampa_indices, 0)
+        # wampa_index and pit_mask now hold the world the chain starts from
+        for _ in range(self.num_samples):
+            for index, rules in zip(pit_indices, rules_of_room):
+                is_pit = pit_mask >> index & 1
+                if index == wampa_index or is_pit and \
+                        any(num_adjacent_pits[rule] == 1 for rule in rules):
+                    continue  # the room cannot change
+                if is_pit != (rng.random() < self.pit_prior):
+                    pit_mask ^= 1 << index
+                    for rule in rules:
+                        num_adjacent_pits[rule] += -1 if is_pit else 1
+            wampa_index = rng.choice([index for index in wampa_indices
+                                      if index < 0 or
+                                      not pit_mask >> index & 1])
+            for index in pit_indices:
+                num_pits[index] += pit_mask >> index & 1
+            num_wampas[wampa_index] += 1
+
+        no_wampa = num_wampas.pop(-1, 0) / self.num_samples
+        return self.risks_outside_space(
+            masks, {index: (num_pits.get(index, 0) / self.num_samples,
+                            num_wampas.get(index, 0) / self.num_samples)
+                    for index in num_pits.keys() | num_wampas.keys()},
+            no_wampa)
+
+    def risks_outside_space(self, masks, index_risks, no_wampa):
+        """Return the {room: (pit probability, wampa probability)} of every
+        candidate room given masks from KB_masks, the probabilities
+        index_risks ({room_index: (pit, wampa)}) of the rooms of world_space
+        and the probability no_wampa that the wampa is in none of them.
+        Rooms outside of world_space hold a pit with probability pit_prior
+        (unless ruled out), and share no_wampa between the ones that can be
+        the wampa. Known pits hold a pit for sure."""
+        other_rooms = [room for room in self.candidate_rooms()
+                       if self.room_index(room) not in index_risks]
+        wampa_rooms = [room for room in other_rooms
+                       if self.wampa_is_consistent(self.room_index(room),
+                                                   masks)]
+        risks = {room: (0 if masks[0] >> self.room_index(room) & 1
+                        else self.pit_prior,
+                        no_wampa / len(wampa_rooms)
+                        if room in wampa_rooms else 0)
+                 for room in other_rooms}
+        risks.update((self.index_to_room[index], risk)
+                     for index, risk in index_risks.items())
+        risks.update((room, (1, 0)) for room in self.KB.pits)
+        return risks
+
+    def exact_risks(self):
+        """Same as sample_risks, but with exact probabilities from weighted
+        model counting over each component of the pit model (see
+        pit_components), where a pit_mask weighs pit_prior for each pit and
+        1 - pit_prior for each other room that can be a pit. Fall back to
+        sample_risks if a component has more than max_exact_rooms pit rooms.
+
+        Components only depend on each other through the wampa, which is not
+        in a pit room. So a wampa room w outside of a component weighs 1 in
+        it, and a wampa room in it weighs the share of its weight without a
+        pit in w. The probability of a pit in one of its rooms mixes the
+        share of its weight with that pit over both cases."""
+        masks = self.KB_masks()
+        space = self.world_space(masks)
+        components = self.pit_components(space)
+        if components is None:
+            return None
+        if any(len(component[0]) > self.max_exact_rooms
+               for component in components):
+            return self.sample_risks()
+        wampa_indices = self.wampa_model(space, masks)
+
+        wampa_weights = dict.fromkeys(wampa_indices, 1.0)
+        component_shares = []  # [(pit shares, {wampa_index: pit shares})]
+        for pit_indices, _, breeze_adjacent_masks in components:
+            pit_indices = [index for index in pit_indices
+                           if not masks[0] >> index & 1]
+            wampa_in_component = [index for index in pit_indices
+                                  if index in wampa_weights]
+            total = 0
+            pit_weights = dict.fromkeys(pit_indices, 0)
+            no_pit_weights = dict.fromkeys(wampa_in_component, 0)
+            pit_weights_without = {index: dict.fromkeys(pit_indices, 0)
+                                   for index in wampa_in_component}
+            for pit_mask in iter_gray_pit_masks(
+                    pit_indices, breeze_adjacent_masks,
+                    0, 2 ** len(pit_indices)):
+                pits = [index for index in pit_indices
+                        if pit_mask >> index & 1]
+                weight = self.pit_prior ** len(pits) * \
+                    (1 - self.pit_prior) ** (len(pit_indices) - len(pits))
+                total += weight
+                for index in pits:
+                    pit_weights[index] += weight
+                for wampa_index in wampa_in_component:
+                    if not pit_mask >> wampa_index & 1:
+                        no_pit_weights[wampa_index] += weight
+                        for index in pits:
+                            pit_weights_without[wampa_index][index] += weight
+            if not total:
+                return None
+            for wampa_index in wampa_in_component:
+                wampa_weights[wampa_index] = \
+                    no_pit_weights[wampa_index] / total
+            component_shares.append((
+                {index: weight / total
+                 for index, weight in pit_weights.items()},
+                {wampa_index: {index: weight / total
+                               for index, weight in weights.items()}
+                 for wampa_index, weights in pit_weights_without.items()}))
+
+        total = sum(wampa_weights.values())
+        if not total:
+            return None
+        index_risks = {index: (0, weight / total)
+                       for index, weight in wampa_weights.items()
+                       if index >= 0}
+        for pit_shares, pit_shares_without in component_shares:
+            # weight of the wampa rooms outside of this component
+            weight_outside = total - sum(wampa_weights[wampa_index]
+                                         for wampa_index in pit_shares_without)
+            for index, share in pit_shares.items():
+                pit_weight = weight_outside * share + \
+                    sum(shares[index]
+                        for shares in pit_shares_without.values())
+                index_risks[index] = (pit_weight / total,
+                                      index_risks.get(index, (0, 0))[1])
+        return self.risks_outside_space(masks, index_risks,
+                                        wampa_weights.get(-1, 0) / total)
+
+    def path_to(self, targets):
+        """Return the shortest list of rooms from the current location to a
+        room in targets, going only through safe rooms that are not walls,
+        or None if no room in targets can be reached that way."""
+        passable = self.KB.safe_rooms - self.KB.walls
+        came_from = {self.loc: None}
+        queue = deque([self.loc])
+        while queue:
+            room = queue.popleft()
+            for adj_room in sorted(self.adjacent_locs(room)):
+                if adj_room in came_from:
+                    continue
+                came_from[adj_room] = room
+                if adj_room in targets:
+                    path = [adj_room]
+                    while came_from[path[-1]] is not None:
+                        path.append(came_from[path[-1]])
+                    return path[::-1]
+                if adj_room in passable:
+                    queue.append(adj_room)
+        return None
+
+    def action_toward(self, room):
+        """Return the action that moves into room, which is adjacent to the
+        current location, or that turns toward it."""
+        delta = (room[0] - self.loc[0], room[1] - self.loc[1])
+        orientation = get_orientation(self.degrees)
+        if ORIENTATION_DELTAS[orientation] == delta:
+            return "forward"
+        if ORIENTATION_DELTAS[(orientation - 1) % 4] == delta:
+            return "left"
+        return "right"
+
+    def plan_action(self):
+        """Return the first action on the shortest safe way to where R2D2
+        should head next, or None if there is nowhere to head to:
+        1. With Luke, back to (0, 0).
+        2. Otherwise, to the nearest safe room that has not been visited.
+        3. Otherwise, if the wampa is known and can be shot, to the nearest
+        room in line with it, and then facing it.
+        4. Otherwise, if take_risks is set, into the nearest of the rooms
+        least likely to hold a pit or the wampa (see exact_risks), as long
+        as that risk is at most max_risk."""
+        if self.has_luke:
+            targets = {(0, 0)}
+        else:
+            targets = self.KB.safe_rooms - self.KB.visited_rooms - \
+                self.KB.walls
+        if not targets and self.blaster and self.KB.wampa:
+            (x, y), (wx, wy) = self.loc, self.KB.wampa
+            if x == wx or y == wy:
+                return self.action_toward((x + (wx > x) - (wx < x),
+                                           y + (wy > y) - (wy < y)))
+            targets = {room for room in self.KB.safe_rooms - self.KB.walls
+                       if room[0] == wx or room[1] == wy}
+        elif not targets and self.take_risks:
+            risks = self.exact_risks()
+            if not risks:
+                return None
+            least_risk = min(sum(risk) for risk in risks.values())
+            if least_risk > self.max_risk:
+                return None
+            targets = {room for room, risk in risks.items()
+                       if sum(risk) <= least_risk + 1e-9}
+        path = self.path_to(targets)
+        if not path or len(path) < 2:
+            return None
+        return self.action_toward(path[1])
+
+    def entailed_queries(self, summary, rooms):
+        """Return the set of (query, room) pairs entailed by the KB for every
+        room in rooms (a {room: room_index} dict), given the summary of the
+        model of the KB (see python_model_summary). A query is entailed if
+        the model of the KB is a subset of the model of the query, i.e. no
+        world of the model refutes it."""
+        all_pits, any_pits, wampa_indices, _ = summary
+        entailed = set()
+        for room, room_index in rooms.items():
+            query_to_value = {
+                "pit_in_room": all_pits >> room_index & 1,
+                "wampa_in_room": wampa_indices <= {room_index},
+                "no_pit_in_room": not any_pits >> room_index & 1,
+                "no_wampa_in_room": room_index not in wampa_indices
+            }
+            entailed.update((query, room)
+                            for query, value in query_to_value.items()
+                            if value)
+        return entailed
+
+    def inference_algorithm(self, time_budget=None, world_budget=None):
         """First, make some basic inferences:
         1. If there is no breeze or stench in current location, infer that the
         adjacent rooms are safe.
@@ -197,16 +1566,22 @@ class Agent:
         4. Infer whether the Wampa is alive given scream percept. Clear stench
         from the KB if Wampa is dead.
 
-        Then, infer whether each adjacent room is safe, pit or wampa by
-        following the backward-chaining resolution algorithm:
+        Then, infer whether each adjacent room (and each other room that could
+        have a pit or a wampa) is safe, pit or wampa by following the
+        backward-chaining resolution algorithm:
         1. Enumerate possible worlds.
         2. Find the model of the KB, i.e. the subset of possible worlds
         consistent with the KB.
-        3. For each adjacent room and each query, find the model of the query.
+        3. For each such room and each query, find the model of the query.
         4. If the model of the KB is a subset of the model of the query, the
         query is entailed by the KB.
         5. Update KB.pits, KB.wampa, and KB.safe_rooms based on any newly
         derived knowledge.
+
+        If time_budget (in seconds) or world_budget (in pit subsets) is
+        given, enumeration stops once it is spent, and only the queries that
+        are entailed whatever the rest of the worlds are get inferred. Return
+        True if inference finished within the budget, False otherwise.
         """
 
         # infer that adjacent rooms are safe if there is no breeze or stench
@@ -221,6 +1596,24 @@ class Agent:
             self.KB.wampa = None
             self.KB.stench.clear()
 
+        # nothing new to infer from if the KB is as the last inference left it
+        # (e.g. after turning left or right, or going back to a visited room)
+        if self.skip_unchanged and self.inferred_state == self.KB_state():
+            return True
+        self.deadline = perf_counter() + time_budget \
+            if time_budget is not None else None
+        self.world_budget = world_budget
+        self.worlds_checked = 0
+        self.finished = True
+
+        # reuse what was inferred from the same KB before, by any agent
+        if self.use_cache:
+            fingerprint = self.KB_fingerprint()
+            inferences = self.cache.get(fingerprint)
+            if inferences is not None:
+                self.update_KB(*inferences)
+                return True
+
         # initialize our four queries and sets to store where the query is true
         pit_in_room = set()
         wampa_in_room = set()
@@ -231,31 +1624,95 @@ class Agent:
                                  "no_pit_in_room": no_pit_in_room,
                                  "no_wampa_in_room": no_wampa_in_room}
 
-        # enumerate possible worlds and find the model of the KB
-        possible_worlds = self.enumerate_possible_worlds()
-        model_of_KB = self.find_model_of_KB(possible_worlds)
+        # find the model of the KB over the world space and check which
+        # queries it entails about each candidate and adj. room that has no
+        # final verdict yet
+        masks = self.KB_masks()
+        rooms = {room: self.room_index(room) for room in
+                 self.candidate_rooms() | self.adjacent_locs(self.loc)
+                 if room not in self.verdicts}
+        space = self.world_space(masks)
+        summary = None
+        if self.propagate:
+            summary = self.propagated_model_summary(space, masks,
+                                                    rooms.values())
+        if summary is None:
+            summary = self.model_summary(space, masks, rooms.values())
+        # known pits were fixed out of space, but are in every world
+        all_pits, any_pits, wampa_indices, model_is_empty = summary
+        known_pit_mask = self.rooms_to_mask(self.KB.pits)
+        summary = (all_pits | known_pit_mask, any_pits | known_pit_mask,
+                   wampa_indices, model_is_empty)
+        entailed = self.entailed_queries(summary, rooms)
 
-        # for each query in each adj. room, find the model of the query
-        # and check if query is entailed by KB
-        for adj_room in self.adjacent_locs(self.loc):
-            for query, inferences in queries_to_inferences.items():
-                model_of_query = self.find_model_of_query(query, adj_room,
-                                                          possible_worlds)
-                if model_of_KB.issubset(model_of_query):
-                    inferences.add(adj_room)
+        # rooms outside the frontier are free: each one may or may not hold a
+        # pit (or the wampa) in any world, as long as that room alone is
+        # consistent with the KB
+        free_rooms = set()
+        if self.frontier_only and not model_is_empty:
+            free_rooms = rooms.keys() & (self.candidate_rooms() -
+                                         self.frontier_rooms())
+        for room in free_rooms:
+            room_index = rooms[room]
+            if self.pits_are_consistent(1 << room_index, masks):
+                entailed.discard(("no_pit_in_room", room))
+            if self.wampa_is_consistent(room_index, masks):
+                entailed.discard(("no_wampa_in_room", room))
+        for query, adj_room in entailed:
+            queries_to_inferences[query].add(adj_room)
+
+        # once stench has been perceived, the wampa can only be in the rooms
+        # that the stench percepts alone leave to it
+        wampa_rooms = set()
+        if masks[3]:
+            wampa_rooms = set(self.mask_to_rooms(self.wampa_mask() &
+                                                 self.rooms_to_mask(
+                                                     self.candidate_rooms() -
+                                                     self.KB.pits)))
+            no_wampa_in_room.update(rooms.keys() - wampa_rooms)
+            if len(wampa_rooms) == 1:
+                wampa_in_room.update(rooms.keys() & wampa_rooms)
+
+        # a room that is safe or a pit stays so whatever is perceived next, so
+        # its verdict is final (unless the KB is inconsistent)
+        safe_rooms = no_pit_in_room.intersection(no_wampa_in_room)
+        verdicts = dict()
+        if not model_is_empty:
+            for room in safe_rooms | pit_in_room:
+                verdicts[room] = frozenset(
+                    query for query, inferences in
+                    queries_to_inferences.items() if room in inferences)
 
         # update KB.safe_rooms, KB.wampa and KB.pits based on new information
-        safe_adjacent_rooms = no_pit_in_room.intersection(no_wampa_in_room)
-        self.KB.safe_rooms.update(safe_adjacent_rooms)
-        self.KB.wampa = wampa_in_room.pop() if wampa_in_room else None
-        self.KB.pits.update(pit_in_room)
+        if wampa_in_room:
+            wampa = wampa_in_room.pop()
+        elif len(wampa_rooms) == 1:
+            wampa = wampa_rooms.pop()
+        else:
+            wampa = None
+        inferences = (frozenset(safe_rooms), frozenset(pit_in_room), wampa,
+                      verdicts)
+        if self.use_cache and self.finished:
+            self.cache.put(fingerprint, inferences)
+        self.update_KB(*inferences)
+        return self.finished
+
+    def update_KB(self, safe_rooms, pits, wampa, verdicts):
+        """Update KB.safe_rooms, KB.pits and KB.wampa, and the verdicts
+        cache, with what an inference derived."""
+        self.KB.safe_rooms.update(safe_rooms)
+        self.KB.pits.update(pits)
+        self.KB.wampa = wampa
+        self.verdicts.update(verdicts)
+        if self.finished:
+            self.inferred_state = self.KB_state()
 
     def all_safe_next_actions(self):
         """Define R2D2's valid and safe next actions based on his current
         location and knowledge of the environment."""
         actions = ['left', 'right']
         x, y = self.loc
-        dx, dy = self.orientation_to_delta[get_direction(self.degrees)]
+        dx, dy = ORIENTATION_DELTAS[get_orientation(self.degrees)]
         forward_room = (x+dx, y+dy)
         if forward_room in self.KB.safe_rooms and \
                 forward_room not in self.KB.walls:
@@ -286,8 +1743,12 @@ class Agent:
         elif 'shoot' in actions:
             self.KB.safe_rooms.add(self.KB.wampa)  # if shot, room safe
             return 'shoot'
+        if self.plan_moves:
+            action = self.plan_action()
+            if action:
+                return action
         x, y = self.loc
-        dx, dy = self.orientation_to_delta[get_direction(self.degrees)]
+        dx, dy = ORIENTATION_DELTAS[get_orientation(self.degrees)]
         forward_room = (x+dx, y+dy)
         if 'forward' in actions and \
             (forward_room not in self.KB.visited_rooms or
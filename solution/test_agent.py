@@ -0,0 +1,402 @@
+import io
+import random
+import unittest
+from contextlib import redirect_stdout
+from itertools import product
+from random import Random
+from agent import InferenceCache, SATSolver, np
+from wampa_world import WampaWorld
+from scenarios import *
+
+
+def agent_with_percepts(visited_rooms, breeze_rooms, stench_rooms=()):
+    """Return an agent at (0, 0) that has visited visited_rooms, perceived
+    breeze in breeze_rooms and stench in stench_rooms (and nothing else),
+    and made the basic inference that the rooms next to a visited room
+    with neither are safe."""
+    agent = WampaWorld(S1).agent
+    agent.KB.visited_rooms = set(visited_rooms)
+    agent.KB.breeze = set(breeze_rooms)
+    agent.KB.stench = set(stench_rooms)
+    agent.KB.safe_rooms = set(visited_rooms)
+    agent.KB.all_locs = set(visited_rooms)
+    for room in visited_rooms:
+        agent.KB.all_locs |= agent.adjacent_locs(room)
+        if room not in agent.KB.breeze | agent.KB.stench:
+            agent.KB.safe_rooms |= agent.adjacent_locs(room)
+    return agent
+
+
+def breezy_agent(breeze_rooms):
+    """Return an agent at (0, 0) that has visited breeze_rooms and perceived
+    breeze (and nothing else) in each of them."""
+    return agent_with_percepts(breeze_rooms, breeze_rooms)
+
+
+def play(scenario, seed, max_steps=300, **options):
+    """Play scenario with the random seed and the given agent attributes set,
+    and return the world and the (safe_rooms, pits, wampa) of the KB after
+    each inference."""
+    random.seed(seed)
+    world = WampaWorld(scenario)
+    for name, value in options.items():
+        setattr(world.agent, name, value)
+    KB, trace = world.agent.KB, []
+    with redirect_stdout(io.StringIO()):
+        for _ in range(max_steps):
+            if not world.is_playing:
+                break
+            world.agent.record_percepts(world.get_percepts())
+            world.agent.inference_algorithm()
+            trace.append((set(KB.safe_rooms), set(KB.pits), KB.wampa))
+            world.take_action(world.agent.choose_next_action())
+    return world, trace
+
+
+class TestSATSolver(unittest.TestCase):
+
+    def is_satisfiable(self, num_vars, clauses):
+        return any(all(any(values[abs(lit) - 1] == (lit > 0) for lit in clause)
+                       for clause in clauses)
+                   for values in product((False, True), repeat=num_vars))
+
+    def test_solve_matches_brute_force(self):
+        rng = Random(0)
+        for _ in range(300):
+            num_vars = rng.randint(1, 7)
+            clauses = [[rng.choice((1, -1)) * rng.randint(1, num_vars)
+                        for _ in range(rng.randint(1, 3))]
+                       for _ in range(rng.randint(1, 25))]
+            solver = SATSolver(num_vars, clauses)
+            # solving again under assumptions reuses the learned clauses
+            for assumptions in ([], [rng.choice((1, -1)) * num_vars]):
+                model = solver.solve(assumptions)
+                self.assertEqual(model is not None, self.is_satisfiable(
+                    num_vars, clauses + [[lit] for lit in assumptions]))
+                if model is None:
+                    continue
+                for clause in clauses + [[lit] for lit in assumptions]:
+                    self.assertTrue(any(model[abs(lit)] == (1 if lit > 0
+                                                            else -1)
+                                        for lit in clause))
+
+    def test_empty_clause_is_unsatisfiable(self):
+        self.assertIsNone(SATSolver(2, [[1, 2], []]).solve())
+        self.assertIsNone(SATSolver(1, [[1], [-1]]).solve())
+
+    def test_sat_backend_matches_python(self):
+        visited_rooms = {(0, 0), (1, 0), (2, 0), (2, 1)}
+        breeze_rooms = {(0, 0), (2, 0)}
+        stench_rooms = {(1, 0), (2, 1)}
+        agent = agent_with_percepts(visited_rooms, breeze_rooms, stench_rooms)
+        agent.inference_algorithm()
+        sat_agent = agent_with_percepts(visited_rooms, breeze_rooms,
+                                        stench_rooms)
+        sat_agent.backend = "sat"
+        sat_agent.inference_algorithm()
+        self.assertEqual(sat_agent.KB.safe_rooms, agent.KB.safe_rooms)
+        self.assertEqual(sat_agent.KB.pits, agent.KB.pits)
+        self.assertEqual(sat_agent.KB.wampa, agent.KB.wampa)
+
+
+class TestWalls(unittest.TestCase):
+
+    def test_queued_bumps_set_every_bound(self):
+        agent = agent_with_percepts({(0, 0), (3, 1), (1, 3)}, ())
+        agent.KB.bump = {(3, 1): "right", (1, 3): "up"}
+        agent.infer_wall_locations()
+        self.assertEqual(agent.KB.bump, {})
+        self.assertEqual(agent.KB.bounds, {1: 3, 0: 3})
+        self.assertEqual(agent.KB.walls, {(4, 1), (1, 4)})
+        self.assertFalse(agent.KB.all_locs & agent.KB.walls)
+        self.assertIn((3, 2), agent.KB.all_locs)
+        self.assertIn((-1, 0), agent.KB.all_locs)
+
+
+class TestRisks(unittest.TestCase):
+
+    cases = [({(0, 0), (1, 0), (2, 0), (2, 1)}, {(0, 0), (2, 0)},
+              {(1, 0), (2, 1)}),
+             ({(0, 0), (0, 1), (1, 1)}, {(0, 1)}, {(0, 0), (1, 1)}),
+             ({(0, 0), (1, 0)}, {(0, 0), (1, 0)}, {(1, 0)}),
+             ({(0, 0)}, {(0, 0)}, {(0, 0)})]
+
+    def posterior(self, agent):
+        """Return the {room: (pit probability, wampa probability)} of every
+        candidate room of agent, by going through every world."""
+        KB, prior = agent.KB, agent.pit_prior
+        rooms = sorted(agent.candidate_rooms())
+        worlds = []  # [(pit rooms, wampa room, weight)]
+        for pits in product((False, True), repeat=len(rooms)):
+            pit_rooms = {room for room, pit in zip(rooms, pits) if pit}
+            if any(bool(agent.adjacent_locs(room) & pit_rooms) !=
+                   (room in KB.breeze) for room in KB.visited_rooms):
+                continue
+            weight = prior ** len(pit_rooms) * \
+                (1 - prior) ** (len(rooms) - len(pit_rooms))
+            for wampa in [None] + rooms:
+                if wampa not in pit_rooms and all(
+                        (wampa in agent.adjacent_locs(room)) ==
+                        (room in KB.stench) for room in KB.visited_rooms):
+                    worlds.append((pit_rooms, wampa, weight))
+        total = sum(weight for _, _, weight in worlds)
+        return {room: (sum(weight for pit_rooms, _, weight in worlds
+                           if room in pit_rooms) / total,
+                       sum(weight for _, wampa, weight in worlds
+                           if wampa == room) / total)
+                for room in rooms}
+
+    def test_exact_risks_match_posterior(self):
+        for visited_rooms, breeze_rooms, stench_rooms in self.cases:
+            agent = agent_with_percepts(visited_rooms, breeze_rooms,
+                                        stench_rooms)
+            risks = agent.exact_risks()
+            posterior = self.posterior(agent)
+            for room in agent.frontier_rooms():
+                self.assertAlmostEqual(risks[room][0], posterior[room][0])
+                self.assertAlmostEqual(risks[room][1], posterior[room][1])
+
+    def test_sample_risks_near_posterior(self):
+        agent = agent_with_percepts(*self.cases[0])
+        agent.num_samples, agent.sample_seed = 20000, 1
+        risks = agent.sample_risks()
+        posterior = self.posterior(agent)
+        for room in agent.frontier_rooms():
+            self.assertAlmostEqual(risks[room][0], posterior[room][0],
+                                   delta=0.05)
+
+    def test_risks_are_opt_in(self):
+        agent = breezy_agent({(0, 0)})
+        agent.inference_algorithm()
+        self.assertIsNone(agent.plan_action())
+        agent.take_risks = True
+        self.assertIn(agent.plan_action(), ("forward", "left", "right"))
+        agent.max_risk = 0.1
+        self.assertIsNone(agent.plan_action())
+
+
+class TestBudget(unittest.TestCase):
+
+    def test_budget_spent_in_first_component(self):
+        # two breezes far apart make two pit components; a budget of one
+        # world runs out in the first, so neither pit model is complete
+        agent = breezy_agent({(0, 0), (4, 0)})
+        self.assertFalse(agent.inference_algorithm(world_budget=1))
+        self.assertEqual(agent.kept_models, {})
+        self.assertTrue(agent.inference_algorithm())
+        candidates = agent.KB.all_locs - {(0, 0), (4, 0)}
+        self.assertFalse(agent.KB.safe_rooms & candidates)
+        self.assertFalse(agent.KB.pits)
+
+    def test_budget_is_sound(self):
+        agent = breezy_agent({(0, 0)})
+        agent.inference_algorithm(world_budget=1)
+        self.assertEqual(agent.KB.safe_rooms, {(0, 0)})
+        self.assertFalse(agent.KB.pits)
+
+    def test_time_budget(self):
+        agent = breezy_agent({(0, 0), (4, 0)})
+        self.assertFalse(agent.inference_algorithm(time_budget=0))
+        self.assertEqual(agent.KB.safe_rooms, {(0, 0), (4, 0)})
+        self.assertTrue(agent.inference_algorithm(time_budget=60))
+
+    def test_budget_applies_to_sat_backend(self):
+        agent = breezy_agent({(0, 0), (4, 0)})
+        agent.backend, agent.propagate = "sat", False
+        self.assertFalse(agent.inference_algorithm(time_budget=0))
+        self.assertEqual(agent.KB.safe_rooms, {(0, 0), (4, 0)})
+        self.assertFalse(agent.KB.pits)
+        self.assertTrue(agent.inference_algorithm(time_budget=60))
+
+    def test_budgeted_games_are_not_lost(self):
+        caves = [S1, S2, S3, S4, S5, S6,
+                 {'grid': [6, 5], 'wampa': [0, 2], 'luke': [3, 4],
+                  'pits': [[2, 4], [1, 4], [3, 3], [4, 3]]}]
+        for cave in caves:
+            random.seed(7)
+            world = WampaWorld(cave)
+            with redirect_stdout(io.StringIO()):
+                for _ in range(300):
+                    if not world.is_playing:
+                        break
+                    world.agent.record_percepts(world.get_percepts())
+                    world.agent.inference_algorithm(world_budget=1)
+                    world.take_action(world.agent.choose_next_action())
+            self.assertGreater(world.agent.score, -1000)
+
+    def test_budget_applies_to_processes(self):
+        agent = breezy_agent({(0, 0), (4, 0)})
+        agent.processes, agent.parallel_threshold = 2, 1
+        self.assertFalse(agent.inference_algorithm(world_budget=1))
+        self.assertEqual(agent.KB.safe_rooms, {(0, 0), (4, 0)})
+        self.assertTrue(agent.inference_algorithm())
+        self.assertEqual(agent.KB.safe_rooms, {(0, 0), (4, 0)})
+        agent.shutdown_pool()
+
+
+class TestKeptSummaries(unittest.TestCase):
+
+    def test_summary_kept_until_percept_next_to_component(self):
+        agent = breezy_agent({(0, 0), (6, 0)})
+        agent.inference_algorithm()
+        near, far = agent.room_index((1, 0)), agent.room_index((7, 0))
+        summaries = {key[0]: value
+                     for key, value in agent.kept_summaries.items()}
+        self.assertEqual(len(summaries), 2)
+
+        # no breeze in (6, 1) only changes the component around (6, 0)
+        agent.KB.visited_rooms.add((6, 1))
+        agent.KB.safe_rooms.add((6, 1))
+        agent.KB.all_locs |= agent.adjacent_locs((6, 1))
+        agent.inference_algorithm()
+        kept = {key[0]: value for key, value in agent.kept_summaries.items()}
+        near_key = [rooms for rooms in kept if near in rooms]
+        far_key = [rooms for rooms in kept if far in rooms]
+        self.assertIs(kept[near_key[0]], summaries[near_key[0]])
+        self.assertNotIn(far_key[0], summaries)
+        self.assertIn((6, 2), agent.KB.safe_rooms)
+
+    def test_pit_model_kept_when_component_shrinks(self):
+        agent = breezy_agent({(0, 0), (6, 0)})
+        agent.inference_algorithm()
+        old_rooms = {rooms for _, rooms in agent.kept_models}
+
+        # no breeze in (6, 1) takes it out of the component around (6, 0)
+        agent.KB.visited_rooms.add((6, 1))
+        agent.KB.safe_rooms.add((6, 1))
+        agent.KB.all_locs |= agent.adjacent_locs((6, 1))
+        agent.iter_pit_model = lambda space, masks: self.fail(
+            "the kept pit model was enumerated again")
+        agent.inference_algorithm()
+        new_rooms = {rooms for _, rooms in agent.kept_models}
+        shrunk = [rooms for rooms in new_rooms - old_rooms
+                  if any(not rooms & ~old for old in old_rooms)]
+        self.assertEqual(len(shrunk), 1)
+        self.assertEqual(len(new_rooms), 2)
+
+
+class TestInferenceOptions(unittest.TestCase):
+
+    caves = [S1, S2, S3, S4, S5, S6,
+             {'grid': [6, 5], 'wampa': [0, 2], 'luke': [3, 4],
+              'pits': [[2, 4], [1, 4], [3, 3], [4, 3]]},
+             {'grid': [7, 7], 'wampa': [5, 1], 'luke': [6, 6],
+              'pits': [[2, 0], [0, 3], [3, 2], [2, 5], [5, 4], [6, 2]]}]
+
+    def test_options_infer_the_same(self):
+        # each of these only changes how the model of the KB is worked out
+        options = ["incremental", "factorized", "decompose", "propagate"]
+        for cave, seed in product(self.caves, range(2)):
+            trace = play(cave, seed)[1]
+            for option in options + [options]:
+                off = dict.fromkeys([option] if isinstance(option, str)
+                                    else option, False)
+                with self.subTest(cave=cave, seed=seed, off=sorted(off)):
+                    other_trace = play(cave, seed, **off)[1]
+                    # only the first step that differs, to keep it readable
+                    step = next((step for step, (a, b) in enumerate(
+                        zip(other_trace, trace)) if a != b), len(trace))
+                    self.assertEqual(other_trace[step:step + 1],
+                                     trace[step:step + 1], f"step {step}")
+                    self.assertEqual(len(other_trace), len(trace))
+
+
+class TestSkipUnchanged(unittest.TestCase):
+
+    def test_skipping_leaves_the_same_KB(self):
+        for scenario in [S1, S2, S3, S4, S5, S6]:
+            for seed in range(3):
+                KB = play(scenario, seed)[0].agent.KB
+                full_KB = play(scenario, seed,
+                               skip_unchanged=False)[0].agent.KB
+                # a full inference also queries the rooms next to R2D2 that
+                # are known walls, and so marks them safe, even when the KB
+                # has nothing new in it; that is the only difference
+                self.assertLessEqual(KB.safe_rooms ^ full_KB.safe_rooms,
+                                     KB.walls)
+                for name, value in vars(KB).items():
+                    if name != "safe_rooms":
+                        self.assertEqual(value, getattr(full_KB, name), name)
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestNumpyBackend(unittest.TestCase):
+
+    def test_numpy_matches_python(self):
+        breeze_rooms = {(0, 0), (2, 0), (1, 1), (5, 0)}
+        agent = breezy_agent(breeze_rooms)
+        agent.inference_algorithm()
+        for factorized in (True, False):
+            numpy_agent = breezy_agent(breeze_rooms)
+            numpy_agent.backend, numpy_agent.factorized = "numpy", factorized
+            numpy_agent.inference_algorithm()
+            self.assertEqual(numpy_agent.KB.safe_rooms, agent.KB.safe_rooms)
+            self.assertEqual(numpy_agent.KB.pits, agent.KB.pits)
+
+    def test_pit_model_matches_python(self):
+        # over every candidate room, the ones next to (1, 1) are ruled out
+        # as pits, but not as the wampa
+        agent = agent_with_percepts({(0, 0), (1, 0), (1, 1)},
+                                    {(0, 0), (1, 0)}, {(1, 1)})
+        agent.frontier_only = False
+        masks = agent.KB_masks()
+        space = agent.world_space(masks)
+        self.assertLess(len(agent.free_pit_indices(space, masks)),
+                        len(space[0]))
+        pits = agent.numpy_pit_model(space, masks)
+        self.assertEqual(pits.shape[1], len(space[0]))
+        self.assertEqual(sorted(sum(1 << index
+                                    for index, pit in zip(space[0], row)
+                                    if pit) for row in pits),
+                         sorted(agent.iter_pit_model(space, masks)))
+
+    def test_large_frontier_is_not_one_matrix(self):
+        # a row of breezes links 25 pit rooms, more than numpy_max_rooms
+        agent = breezy_agent({(2 * i, 0) for i in range(8)})
+        agent.backend, agent.decompose = "numpy", False
+        self.assertFalse(agent.inference_algorithm(world_budget=4096))
+        self.assertFalse(agent.KB.pits)
+
+
+class TestInferenceCache(unittest.TestCase):
+
+    def test_same_KB_anywhere_hits(self):
+        cache = InferenceCache()
+        agents = [breezy_agent({(0, 0), (2, 0)}) for _ in range(2)]
+        agents[1].loc = (2, 0)
+        for agent in agents:
+            agent.use_cache, agent.cache = True, cache
+            agent.inference_algorithm()
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "size": 1})
+        self.assertEqual(agents[1].KB.safe_rooms, agents[0].KB.safe_rooms)
+        self.assertEqual(agents[1].KB.pits, agents[0].KB.pits)
+
+
+class TestProcesses(unittest.TestCase):
+
+    def test_pool_is_kept_between_inferences(self):
+        agent = breezy_agent({(0, 0), (4, 0)})
+        agent.processes, agent.parallel_threshold = 2, 1
+        agent.inference_algorithm()
+        self.assertIsNotNone(agent.kept_pool)
+        pool = agent.kept_pool[1]
+        agent.KB.visited_rooms.add((0, 1))
+        agent.KB.safe_rooms.add((0, 1))
+        agent.inference_algorithm()
+        self.assertIs(agent.kept_pool[1], pool)
+        agent.shutdown_pool()
+        self.assertIsNone(agent.kept_pool)
+
+    def test_processes_match_one_process(self):
+        agent = breezy_agent({(0, 0), (2, 0), (1, 1)})
+        agent.inference_algorithm()
+        parallel_agent = breezy_agent({(0, 0), (2, 0), (1, 1)})
+        parallel_agent.processes, parallel_agent.parallel_threshold = 2, 1
+        parallel_agent.inference_algorithm()
+        parallel_agent.shutdown_pool()
+        self.assertEqual(parallel_agent.KB.safe_rooms, agent.KB.safe_rooms)
+        self.assertEqual(parallel_agent.KB.pits, agent.KB.pits)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import io
+import random
+import unittest
+from contextlib import redirect_stdout
+from wampa_world import WampaWorld, SparseWampaWorld, run_game
+from scenarios import *
+
+SCENARIOS = [S1, S2, S3, S4, S5, S6]
+
+
+def play(world, seed, max_steps=300):
+    """Play a game in world and return its (location, percepts) trace."""
+    random.seed(seed)
+    trace = []
+    with redirect_stdout(io.StringIO()):
+        for _ in range(max_steps):
+            if not world.is_playing:
+                break
+            percepts = world.get_percepts()
+            trace.append((world.agent.loc, tuple(percepts)))
+            world.agent.record_percepts(percepts)
+            world.agent.inference_algorithm()
+            world.take_action(world.agent.choose_next_action())
+    return trace
+
+
+class TestSparseWampaWorld(unittest.TestCase):
+
+    def test_percepts_match_dense_world(self):
+        for scenario in SCENARIOS:
+            world, sparse_world = WampaWorld(scenario), \
+                SparseWampaWorld(scenario)
+            for x in range(world.X):
+                for y in range(world.Y):
+                    world.agent.loc = sparse_world.agent.loc = (x, y)
+                    self.assertEqual(sparse_world.get_percepts(),
+                                     world.get_percepts())
+                    self.assertEqual(sparse_world.get_percept_flags(),
+                                     world.get_percept_flags())
+
+    def test_games_match_dense_world(self):
+        for scenario in SCENARIOS:
+            for seed in range(3):
+                world, sparse_world = WampaWorld(scenario), \
+                    SparseWampaWorld(scenario)
+                self.assertEqual(play(sparse_world, seed), play(world, seed))
+                self.assertEqual(sparse_world.agent.score, world.agent.score)
+
+    def test_scream_clears_stench(self):
+        world = SparseWampaWorld(S1)  # the Wampa is in (0, 2)
+        world.agent.loc = (0, 1)
+        self.assertEqual(world.get_percepts()[0], "stench")
+        world.agent.KB.wampa = (0, 2)
+        with redirect_stdout(io.StringIO()):
+            world.take_action("shoot")
+        self.assertFalse(world.wampaAlive)
+        self.assertEqual(world.get_percepts()[0], None)
+        self.assertEqual(world.get_percepts()[4], "scream")
+
+    def test_unbounded_cave(self):
+        world = SparseWampaWorld({"grid": None, "wampa": [5, 5],
+                                  "pits": [[-3, 0]], "luke": [1, 1]})
+        world.agent.degrees = 270  # facing left, past where a wall would be
+        with redirect_stdout(io.StringIO()):
+            world.take_action("forward")
+            world.take_action("forward")
+        self.assertEqual(world.agent.loc, (-2, 0))
+        self.assertEqual(world.get_percepts(),
+                         [None, "breeze", None, None, None])
+        self.assertEqual(len(world.room_flags), 1)
+
+
+class TestRunGame(unittest.TestCase):
+
+    def test_percept_flags_match_percepts(self):
+        # run_game records percepts as bit flags, play as percept lists
+        for scenario in SCENARIOS:
+            for seed in range(3):
+                world = WampaWorld(scenario)
+                play(world, seed, max_steps=10 ** 4)
+                random.seed(seed)
+                with redirect_stdout(io.StringIO()):
+                    result = run_game(scenario, sparse=True)
+                self.assertEqual(result, (world.agent.score,
+                                          world.agent.has_luke,
+                                          world.agent.loc))
+
+
+if __name__ == '__main__':
+    unittest.main()